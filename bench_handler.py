@@ -0,0 +1,274 @@
+"""
+Offline benchmark for rp_handler.handler.
+
+Drives the real handler (decode, PDF open, rasterization, result reading,
+merging, output compaction, ...) on the bundled sample files, with the
+DotsOCR model replaced by a stub parser that replays the recorded outputs in
+test_result_dotsocr/ after a configurable simulated latency. Runs on a
+CPU-only machine, so regressions in the non-model parts of the pipeline can
+be caught without a GPU or a RunPod endpoint.
+
+Usage:
+    python bench_handler.py
+    python bench_handler.py --latency-ms 500 --repeat 3 --option render_workers=0
+    python bench_handler.py --samples HeyJude.pdf Resume.png --json bench.json
+    python bench_handler.py --requests jobs.jsonl
+"""
+import argparse
+import base64
+import glob
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SAMPLES = [
+    "HeyJude.pdf",
+    "Resume_3_pages.pdf",
+    "Test Pathology Result.pdf",
+    "HeyJude.png",
+    "Resume.png",
+    "20250830-072543.png",
+    "Hey-Jude-Songsheet-1.jpg",
+]
+
+PDF_PAGE_HEADER_RE = re.compile(r'\n\n## Page (\d+)\n\n')
+
+
+def load_recorded_pages(results_dir):
+    """Split the recorded RunPod responses into per-page (markdown, layout) pairs"""
+    pages = []
+    for path in sorted(glob.glob(os.path.join(results_dir, "*.json"))):
+        with open(path, 'r', encoding='utf-8') as f:
+            output = json.load(f).get("output", {})
+        markdown = output.get("markdown", "")
+        layout_data = output.get("layout_data", [])
+
+        if output.get("input_type") != "pdf":
+            pages.append((markdown, layout_data))
+            continue
+
+        # "## Page N" 标题由handler添加，回放时去掉，只保留模型输出本身
+        parts = PDF_PAGE_HEADER_RE.split(markdown)
+        for i in range(1, len(parts), 2):
+            page_number = int(parts[i])
+            page_layout = [
+                {key: value for key, value in item.items() if key != "page_number"}
+                for item in layout_data
+                if isinstance(item, dict) and item.get("page_number") == page_number
+            ]
+            pages.append((parts[i + 1], page_layout))
+
+    if not pages:
+        raise SystemExit(f"No recorded outputs found in {results_dir}")
+    return pages
+
+
+class ReplayParser:
+    """Stand-in for DotsOCRParser that replays recorded pages after a simulated latency
+
+    Only exposes parse_file, so the handler uses its temp-file input path.
+    """
+
+    use_hf = False
+
+    def __init__(self, recorded_pages, latency_ms=0.0, jitter_ms=0.0, output_dir=None):
+        self.recorded_pages = recorded_pages
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.output_dir = output_dir or tempfile.mkdtemp(prefix="dotsocr_bench_")
+        self.calls = 0
+
+    def _replay(self, prompt_mode, save_dir, save_name):
+        markdown, layout_data = self.recorded_pages[self.calls % len(self.recorded_pages)]
+        self.calls += 1
+
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+
+        # 与DotsOCRParser相同：结果写到文件，返回文件路径
+        result = {}
+        if prompt_mode != "prompt_ocr":
+            if prompt_mode == "prompt_layout_only_en":
+                layout_data = [{key: value for key, value in item.items() if key != "text"} for item in layout_data]
+            layout_info_path = os.path.join(save_dir, f"{save_name}.json")
+            with open(layout_info_path, 'w', encoding='utf-8') as f:
+                json.dump(layout_data, f, ensure_ascii=False)
+            result["layout_info_path"] = layout_info_path
+        if prompt_mode != "prompt_layout_only_en":
+            md_content_path = os.path.join(save_dir, f"{save_name}.md")
+            with open(md_content_path, 'w', encoding='utf-8') as f:
+                f.write(markdown)
+            result["md_content_path"] = md_content_path
+        return result
+
+    def parse_file(self, input_path, output_dir="", prompt_mode="prompt_layout_all_en", bbox=None, fitz_preprocess=False):
+        filename = os.path.splitext(os.path.basename(input_path))[0]
+        save_dir = os.path.join(os.path.abspath(output_dir or self.output_dir), filename)
+        os.makedirs(save_dir, exist_ok=True)
+        result = self._replay(prompt_mode, save_dir, filename)
+        result["file_path"] = input_path
+        return [result]
+
+
+class InMemoryReplayParser(ReplayParser):
+    """ReplayParser that also accepts PIL images like DotsOCRParser._parse_single_image"""
+
+    def _parse_single_image(self, origin_image, prompt_mode, save_dir, save_name, source="image", page_idx=0, bbox=None, fitz_preprocess=False):
+        return self._replay(prompt_mode, save_dir, save_name)
+
+
+def parse_option(text):
+    """key=value, where value is parsed as JSON when possible (numbers, true/false)"""
+    key, _, value = text.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def load_jobs(samples, requests_path):
+    """Build (name, job input) pairs from sample files and an optional JSONL of RunPod jobs"""
+    jobs = []
+    for sample in samples:
+        path = sample if os.path.isabs(sample) else os.path.join(REPO_DIR, sample)
+        if not os.path.exists(path):
+            print(f"Skipping missing sample: {sample}", file=sys.stderr)
+            continue
+        with open(path, 'rb') as f:
+            data = base64.b64encode(f.read()).decode("ascii")
+        key = "pdf_base64" if path.lower().endswith(".pdf") else "image_base64"
+        jobs.append((os.path.basename(path), {key: data}))
+
+    if requests_path and os.path.exists(requests_path):
+        skipped = 0
+        with open(requests_path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                job = json.loads(line)
+                job_input = job.get("input") if isinstance(job, dict) else None
+                if not isinstance(job_input, dict) or not (job_input.get("pdf_base64") or job_input.get("image_base64")):
+                    skipped += 1
+                    continue
+                jobs.append((f"{os.path.basename(requests_path)}:{line_number}", job_input))
+        if skipped:
+            print(f"Skipped {skipped} line(s) of {requests_path} without an inline pdf/image job input", file=sys.stderr)
+    return jobs
+
+
+def run_job(rp_handler, job_input, options):
+    event = {"id": "bench", "input": {**job_input, **options}}
+    start = time.perf_counter()
+    response = rp_handler.handler(event)
+    wall_s = time.perf_counter() - start
+    response_bytes = len(json.dumps(response, ensure_ascii=False).encode("utf-8"))
+
+    # gzip信封把timings放在压缩数据之外
+    timings = response.get("timings", {})
+    if response.get("encoding") == "gzip+base64":
+        response = json.loads(gzip.decompress(base64.b64decode(response["data"])))
+    if "error" in response:
+        raise RuntimeError(response["error"])
+
+    return {
+        "wall_s": wall_s,
+        "pages": response.get("total_pages", 1),
+        "stages": timings.get("stages", {}),
+        "peak_rss_bytes": timings.get("peak_rss_bytes") or 0,
+        "response_bytes": response_bytes,
+    }
+
+
+def summarize(name, runs):
+    wall_s = sum(run["wall_s"] for run in runs) / len(runs)
+    pages = runs[0]["pages"]
+    stages = {}
+    for run in runs:
+        for stage, seconds in run["stages"].items():
+            stages[stage] = stages.get(stage, 0.0) + seconds / len(runs)
+    return {
+        "name": name,
+        "runs": len(runs),
+        "pages": pages,
+        "wall_s": round(wall_s, 4),
+        "pages_per_s": round(pages / wall_s, 3) if wall_s else None,
+        "stages": {stage: round(seconds, 4) for stage, seconds in sorted(stages.items(), key=lambda item: -item[1])},
+        "peak_rss_mb": round(max(run["peak_rss_bytes"] for run in runs) / 1024 / 1024, 1),
+        "response_bytes": runs[-1]["response_bytes"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for rp_handler.handler with a replaying stub parser")
+    parser.add_argument("--samples", nargs="+", default=DEFAULT_SAMPLES, help="sample files (relative to the repo)")
+    parser.add_argument("--requests", default=None, help="JSONL of RunPod jobs ({\"input\": {...}}) to replay as well (none by default)")
+    parser.add_argument("--results-dir", default=os.path.join(REPO_DIR, "test_result_dotsocr"), help="recorded outputs to replay")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated model latency per page")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random +/- jitter added to the latency")
+    parser.add_argument("--repeat", type=int, default=3, help="measured runs per sample")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured runs per sample")
+    parser.add_argument("--path-input", action="store_true", help="stub only accepts file paths (temp PNG input path)")
+    parser.add_argument("--cache", action="store_true", help="leave the result cache on (bypassed by default)")
+    parser.add_argument("--option", action="append", default=[], type=parse_option, metavar="KEY=VALUE", help="extra job input option, e.g. image_mode=strip")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the handler's INFO logging")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    import rp_handler
+    if not args.verbose:
+        logging.getLogger(rp_handler.__name__).setLevel(logging.WARNING)
+
+    recorded_pages = load_recorded_pages(args.results_dir)
+    parser_class = ReplayParser if args.path_input else InMemoryReplayParser
+    rp_handler._PARSER = parser_class(recorded_pages, args.latency_ms, args.jitter_ms)
+    rp_handler._INMEMORY_INPUT_SUPPORTED = None
+
+    options = dict(args.option)
+    if not args.cache:
+        options.setdefault("use_cache", False)
+
+    jobs = load_jobs(args.samples, args.requests)
+    if not jobs:
+        raise SystemExit("No benchmark jobs")
+
+    results = []
+    for name, job_input in jobs:
+        for _ in range(args.warmup):
+            run_job(rp_handler, job_input, options)
+        runs = [run_job(rp_handler, job_input, options) for _ in range(args.repeat)]
+        results.append(summarize(name, runs))
+
+    total_pages = sum(result["pages"] for result in results)
+    total_wall_s = sum(result["wall_s"] for result in results)
+
+    print(f"\n{'sample':<36} {'pages':>5} {'wall s':>8} {'pages/s':>8} {'peak MB':>8} {'resp bytes':>11}  top stages")
+    for result in results:
+        top_stages = ", ".join(f"{stage}={seconds:.3f}" for stage, seconds in list(result["stages"].items())[:4])
+        print(f"{result['name'][:36]:<36} {result['pages']:>5} {result['wall_s']:>8.3f} {result['pages_per_s']:>8.2f} "
+              f"{result['peak_rss_mb']:>8.1f} {result['response_bytes']:>11}  {top_stages}")
+    print(f"{'TOTAL':<36} {total_pages:>5} {total_wall_s:>8.3f} {total_pages / total_wall_s:>8.2f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                "latency_ms": args.latency_ms,
+                "options": options,
+                "results": results,
+                "total_pages": total_pages,
+                "total_wall_s": round(total_wall_s, 4),
+            }, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""
+Local checks for rp_handler's network paths.
+
+Starts a throwaway http.server on 127.0.0.1 that misbehaves on purpose and
+drives the handler's own network code against it:
+
+  download  _download_to_spool (pdf_url / image_url inputs): truncated
+            bodies with and without Content-Length (ChunkedEncodingError
+            restart), 503/429 retries, DOWNLOAD_MAX_BYTES, spool cleanup
+  openai    _openai_generate_batch (DOTSOCR_BACKEND=openai) against a fake
+            chat/completions endpoint: 503/429 and dropped-connection
+            retries, giving up, DOTSOCR_OPENAI_CONCURRENCY cap
+
+Needs no GPU, model or RunPod endpoint, only the handler's own
+dependencies. Exits non-zero when a check fails.
+
+Usage:
+    python check_network.py
+    python check_network.py --only download --verbose
+    python check_network.py --only openai
+"""
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BODY = os.urandom(300 * 1024)
+BODY_SHA256 = hashlib.sha256(BODY).hexdigest()
+
+
+class MisbehavingServer(http.server.ThreadingHTTPServer):
+    """ThreadingHTTPServer that counts requests per path"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RequestHandler)
+        self.hits = {}
+        self.lock = threading.Lock()
+        # 同时在处理的chat/completions请求数及其峰值
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def hit(self, path):
+        with self.lock:
+            self.hits[path] = self.hits.get(path, 0) + 1
+            return self.hits[path]
+
+    def handle_error(self, request, client_address):
+        # 客户端按预期中途放弃（超过大小上限等）时连接被重置，不打印堆栈
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # 路径格式：/<行为>/<参数>/<唯一id>，id让每个检查有自己的请求计数
+        parts = self.path.strip("/").split("/")
+        action, arg = parts[0], parts[1] if len(parts) > 2 else ""
+        attempt = self.server.hit(self.path)
+
+        if action == "ok":
+            self.send_body(BODY)
+        elif action == "truncate":
+            # 前arg次：声明完整的Content-Length，只发一半就断开
+            if attempt <= int(arg):
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(BODY)))
+                self.end_headers()
+                self.wfile.write(BODY[:len(BODY) // 2])
+                self.close_connection = True
+            else:
+                self.send_body(BODY)
+        elif action == "chunked-cut":
+            # 前arg次：chunked传输发了一个块就断开，没有结束块
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            chunks = [BODY[:len(BODY) // 2]] if attempt <= int(arg) else [BODY[:len(BODY) // 2], BODY[len(BODY) // 2:]]
+            for chunk in chunks:
+                self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+            if attempt <= int(arg):
+                self.close_connection = True
+            else:
+                self.wfile.write(b"0\r\n\r\n")
+        elif action == "status":
+            # 依次返回arg里的状态码，之后返回完整内容
+            codes = [int(code) for code in arg.split(",")]
+            if attempt <= len(codes):
+                self.send_status(codes[attempt - 1])
+            else:
+                self.send_body(BODY)
+        elif action == "always":
+            self.send_status(int(arg))
+        elif action == "chunked":
+            # 不带Content-Length，只能边下载边检查大小
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for start in range(0, len(BODY), 64 * 1024):
+                chunk = BODY[start:start + 64 * 1024]
+                self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_status(404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_status(404)
+            return
+        # prompt（去掉图像占位前缀）格式：<行为>:<参数>:<唯一id>
+        prompt = body["messages"][0]["content"][1]["text"].rsplit(">", 1)[-1]
+        action, arg, _ = prompt.split(":")
+        attempt = self.server.hit(prompt)
+
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            if action == "ok":
+                time.sleep(float(arg))
+                self.send_completion(prompt)
+            elif action == "status":
+                codes = [int(code) for code in arg.split(",")]
+                if attempt <= len(codes):
+                    self.send_status(codes[attempt - 1])
+                else:
+                    self.send_completion(prompt)
+            elif action == "always":
+                self.send_status(int(arg))
+            elif action == "drop":
+                # 前arg次：不返回任何响应直接断开连接
+                if attempt <= int(arg):
+                    self.close_connection = True
+                else:
+                    self.send_completion(prompt)
+            else:
+                self.send_status(400)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def send_completion(self, content):
+        body = json.dumps({"choices": [{"message": {"role": "assistant", "content": content}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_body(self, body):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_status(self, code):
+        body = f"status {code}".encode("ascii")
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Checks:
+    """Collects check outcomes and prints one line per check"""
+
+    def __init__(self):
+        self.failed = []
+
+    def run(self, name, check):
+        start = time.perf_counter()
+        try:
+            detail = check()
+        except Exception as e:
+            self.failed.append(name)
+            print(f"FAIL  {name}: {type(e).__name__}: {e}")
+            return
+        detail = str(detail).splitlines()[0] if detail else ""
+        print(f"ok    {name} ({time.perf_counter() - start:.2f}s){f': {detail}' if detail else ''}")
+
+
+def check_downloads(rp_handler, server, checks):
+    spool_dir = tempfile.mkdtemp(prefix="dotsocr_check_spool_")
+    rp_handler.SPOOL_DIR = spool_dir
+
+    def download(path):
+        document = rp_handler._download_to_spool(f"{server.base_url}{path}", ".pdf")
+        try:
+            with open(document.path, "rb") as f:
+                data = f.read()
+        finally:
+            rp_handler._remove_spool(document.path)
+        assert data == BODY, f"spooled {len(data)} bytes, expected {len(BODY)}"
+        assert document.sha256 == BODY_SHA256, "sha256 computed while streaming does not match the body"
+        return server.hits[path]
+
+    def expect_failure(path, error_type):
+        url = path if "://" in path else f"{server.base_url}{path}"
+        try:
+            rp_handler._download_to_spool(url, ".pdf")
+        except error_type as e:
+            assert not os.listdir(spool_dir), f"spool files left behind: {os.listdir(spool_dir)}"
+            return f"{type(e).__name__} after {server.hits.get(path, 0)} request(s)"
+        raise AssertionError(f"expected {error_type.__name__}")
+
+    def requests_after(path, expected):
+        def check():
+            count = download(path)
+            assert count == expected, f"{count} requests, expected {expected}"
+            return f"{count} requests"
+        return check
+
+    import requests
+    checks.run("download: complete body", requests_after("/ok/-/1", 1))
+    checks.run("download: Content-Length body cut off once, restarted", requests_after("/truncate/1/2", 2))
+    checks.run("download: chunked body cut off twice, restarted", requests_after("/chunked-cut/2/3", 3))
+    checks.run("download: 503 then 429, retried by the session", requests_after("/status/503,429/4", 3))
+    checks.run("download: cut off on every attempt gives up",
+               lambda: expect_failure(f"/truncate/{rp_handler.DOWNLOAD_RETRIES + 1}/5", requests.exceptions.ChunkedEncodingError))
+    checks.run("download: persistent 503 gives up", lambda: expect_failure("/always/503/6", requests.exceptions.RetryError))
+    checks.run("download: 404 is not retried", lambda: expect_failure("/always/404/7", requests.exceptions.HTTPError))
+
+    max_bytes = rp_handler.DOWNLOAD_MAX_BYTES
+    rp_handler.DOWNLOAD_MAX_BYTES = len(BODY) // 3
+    try:
+        checks.run("download: Content-Length over DOWNLOAD_MAX_BYTES rejected", lambda: expect_failure("/ok/-/8", ValueError))
+        checks.run("download: chunked body over DOWNLOAD_MAX_BYTES stopped", lambda: expect_failure("/chunked/-/9", ValueError))
+    finally:
+        rp_handler.DOWNLOAD_MAX_BYTES = max_bytes
+
+    checks.run("download: unsupported URL scheme rejected", lambda: expect_failure("ftp://127.0.0.1/x.pdf", ValueError))
+    os.rmdir(spool_dir)
+
+
+def check_openai(rp_handler, server, checks):
+    import httpx
+    from PIL import Image
+    # 客户端在第一次使用时创建，必须在那之前指向本地服务
+    rp_handler.OPENAI_BASE_URL = f"{server.base_url}/v1"
+    rp_handler.OPENAI_CONCURRENCY = 2
+    image = Image.new("RGB", (64, 48), "white")
+
+    def generate(prompts):
+        return rp_handler._openai_generate_batch(None, [image] * len(prompts), prompts)
+
+    def succeeds_after(prompt, expected):
+        def check():
+            result = generate([prompt])[0]
+            if isinstance(result, Exception):
+                raise result
+            assert result == prompt, f"unexpected content {result!r}"
+            assert server.hits[prompt] == expected, f"{server.hits[prompt]} requests, expected {expected}"
+            return f"{server.hits[prompt]} requests"
+        return check
+
+    def fails_after(prompt, expected, error_type=RuntimeError):
+        def check():
+            result = generate([prompt])[0]
+            assert isinstance(result, error_type), f"expected {error_type.__name__}, got {result!r}"
+            assert server.hits[prompt] == expected, f"{server.hits[prompt]} requests, expected {expected}"
+            return f"{server.hits[prompt]} requests: {result}"
+        return check
+
+    def concurrency_cap():
+        server.max_in_flight = 0
+        prompts = [f"ok:0.2:c{i}" for i in range(6)]
+        results = generate(prompts)
+        errors = [result for result in results if isinstance(result, Exception)]
+        assert not errors, f"failed requests: {errors}"
+        assert results == prompts, "responses out of order"
+        assert server.max_in_flight == rp_handler.OPENAI_CONCURRENCY, \
+            f"{server.max_in_flight} requests in flight, expected {rp_handler.OPENAI_CONCURRENCY}"
+        return f"6 pages, at most {server.max_in_flight} in flight"
+
+    retries = rp_handler.OPENAI_RETRIES
+    checks.run("openai: concurrent pages capped by DOTSOCR_OPENAI_CONCURRENCY", concurrency_cap)
+    checks.run("openai: 503 then 429, retried", succeeds_after("status:503,429:r1", 3))
+    checks.run("openai: dropped connection, retried", succeeds_after("drop:1:r2", 2))
+    checks.run("openai: persistent 500 gives up", fails_after("always:500:r3", retries + 1))
+    checks.run("openai: 400 is not retried", fails_after("always:400:r4", 1, httpx.HTTPStatusError))
+
+    def failure_isolated():
+        results = generate(["ok:0:i1", "always:400:i2", "ok:0:i3"])
+        assert results[0] == "ok:0:i1" and results[2] == "ok:0:i3", f"unexpected results {results!r}"
+        assert isinstance(results[1], Exception), "failing page did not fail"
+        return "1 of 3 pages failed"
+    checks.run("openai: a failing page does not fail the others", failure_isolated)
+
+
+CHECKS = {
+    "download": check_downloads,
+    "openai": check_openai,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check rp_handler's network code against a local misbehaving HTTP server")
+    parser.add_argument("--only", nargs="+", choices=sorted(CHECKS), help="run only these groups of checks")
+    parser.add_argument("--verbose", action="store_true", help="keep the handler's INFO logging")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    import rp_handler
+    if not args.verbose:
+        logging.getLogger(rp_handler.__name__).setLevel(logging.ERROR)
+
+    server = MisbehavingServer()
+    threading.Thread(target=server.serve_forever, name="check-http", daemon=True).start()
+    checks = Checks()
+    try:
+        for name in args.only or CHECKS:
+            CHECKS[name](rp_handler, server, checks)
+    finally:
+        server.shutdown()
+
+    if checks.failed:
+        raise SystemExit(f"\n{len(checks.failed)} check(s) failed")
+    print("\nAll checks passed")
+
+
+if __name__ == '__main__':
+    main()
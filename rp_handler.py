@@ -1,9 +1,32 @@
+import time
+# 冷启动统计：模块导入从这里开始计时
+_IMPORT_START = time.perf_counter()
+
 import runpod
+import array
+import asyncio
 import base64
+import collections
+import contextlib
+import contextvars
+import copy
+import gzip
+import hashlib
 import io
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import queue
+import re
+import shutil
 import sys
-from PIL import Image
+import threading
+import uuid
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageChops
 import tempfile
 import logging
 import fitz  # PyMuPDF for PDF processing
@@ -23,6 +46,152 @@ if src_dir not in sys.path:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 冷启动耗时分解（秒），由_initialize_worker和_make_parser填充，附在该worker第一个响应里
+_STARTUP_REPORT = {"module_import_s": round(time.perf_counter() - _IMPORT_START, 3)}
+_STARTUP_REPORTED = False
+
+# --- begin: per-stage instrumentation ---
+# 大体积的原始结果日志（整段base64 markdown）默认关闭，需要调试时设置DOTSOCR_LOG_PAYLOADS=1
+LOG_PAYLOADS = os.getenv("DOTSOCR_LOG_PAYLOADS", "0") == "1"
+STATS_WINDOW = int(os.getenv("DOTSOCR_STATS_WINDOW", "1000"))
+STATS_LOG_EVERY = int(os.getenv("DOTSOCR_STATS_LOG_EVERY", "50"))
+
+# 当前任务的计时器；asyncio.to_thread会复制context，所以并发任务互不影响
+_JOB_METRICS = contextvars.ContextVar("dotsocr_job_metrics", default=None)
+# 每个阶段最近STATS_WINDOW次耗时，用于滚动分位数
+_STAGE_HISTORY = collections.defaultdict(lambda: collections.deque(maxlen=STATS_WINDOW))
+_STAGE_HISTORY_LOCK = threading.Lock()
+_JOBS_FINISHED = 0
+
+def _add_stage_time(stage, seconds):
+    """Add time to a stage of the current job and to the rolling history"""
+    metrics = _JOB_METRICS.get()
+    if metrics is not None:
+        metrics["stages"][stage] = metrics["stages"].get(stage, 0.0) + seconds
+    _add_stage_history(stage, seconds)
+
+def _add_stage_history(stage, seconds):
+    """Add a sample to the rolling history only, for series that overlap the job's stages"""
+    with _STAGE_HISTORY_LOCK:
+        _STAGE_HISTORY[stage].append(seconds)
+
+def _stage_percentile(stage, q):
+    """Rolling percentile of a stage's recent samples, None without history"""
+    with _STAGE_HISTORY_LOCK:
+        samples = sorted(_STAGE_HISTORY.get(stage, ()))
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+@contextlib.contextmanager
+def _stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_stage_time(stage, time.perf_counter() - start)
+
+def _reset_peak_rss():
+    # Linux：向clear_refs写5会重置VmHWM，之后读到的就是本任务期间的峰值
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def _peak_rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return None
+
+def _job_start():
+    """perf_counter at the start of the current job (now outside a job)"""
+    metrics = _JOB_METRICS.get()
+    return metrics["start"] if metrics is not None else time.perf_counter()
+
+def _begin_job_metrics(input_data):
+    """Start timing a job; bytes_in is the size of the inline payload, downloads add to it"""
+    payload = input_data.get('pdf_base64') or input_data.get('image_base64') or ""
+    if MAX_CONCURRENCY <= 1:
+        # VmHWM是进程级的：只有任务逐个执行时，重置后的峰值才属于本任务
+        _reset_peak_rss()
+    _JOB_METRICS.set({"start": time.perf_counter(), "stages": {}, "bytes_in": len(payload)})
+
+def _add_bytes_in(nbytes):
+    metrics = _JOB_METRICS.get()
+    if metrics is not None:
+        metrics["bytes_in"] += nbytes
+
+def _rolling_stage_summary():
+    """p50/p90/p99/max per stage over the last STATS_WINDOW samples"""
+    summary = {}
+    with _STAGE_HISTORY_LOCK:
+        history = {stage: sorted(samples) for stage, samples in _STAGE_HISTORY.items()}
+    for stage, samples in history.items():
+        if not samples:
+            continue
+        def percentile(q):
+            return round(samples[min(len(samples) - 1, int(q * len(samples)))], 4)
+        summary[stage] = {"count": len(samples), "p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99), "max": round(samples[-1], 4)}
+    return summary
+
+def _estimate_json_bytes(value):
+    """Approximate JSON size of a response without serializing it
+
+    Strings (markdown, base64 data) dominate and are counted by length;
+    non-ASCII text is counted one byte per character.
+    """
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, dict):
+        return 2 + sum(len(key) + 4 + _estimate_json_bytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return 2 + sum(_estimate_json_bytes(item) + 1 for item in value)
+    if value is None or isinstance(value, bool):
+        return 5
+    return len(repr(value))
+
+def _attach_timings(response):
+    """Add the current job's timings block (stages, peak RSS, bytes in/out) to the response
+
+    Runs on the final (possibly gzip-enveloped) response, so bytes_out is
+    the estimated size of what is actually returned. With concurrent jobs
+    the peak RSS is the process-wide peak (process_peak_rss_bytes).
+    """
+    global _JOBS_FINISHED
+    metrics = _JOB_METRICS.get()
+    if metrics is None or not isinstance(response, dict):
+        return response
+
+    timings = {
+        "stages": {stage: round(seconds, 4) for stage, seconds in metrics["stages"].items()},
+        "total_s": round(time.perf_counter() - metrics["start"], 4),
+        "bytes_in": metrics["bytes_in"],
+        "bytes_out": _estimate_json_bytes(response)
+    }
+    if MAX_CONCURRENCY <= 1:
+        timings["peak_rss_bytes"] = _peak_rss_bytes()
+    else:
+        timings["process_peak_rss_bytes"] = _peak_rss_bytes()
+    response["timings"] = timings
+    _add_stage_time("job_total", time.perf_counter() - metrics["start"])
+    _JOB_METRICS.set(None)
+
+    _JOBS_FINISHED += 1
+    if STATS_LOG_EVERY > 0 and _JOBS_FINISHED % STATS_LOG_EVERY == 0:
+        logger.info(f"Rolling stage timings after {_JOBS_FINISHED} jobs: {_rolling_stage_summary()}")
+    return response
+# --- end: per-stage instrumentation ---
+
 # --- begin: robust DotsOCR init ---
 import inspect
 
@@ -39,8 +208,27 @@ MODEL_DIR = (
 )
 
 _PARSER = None
+# 并发模式下多个任务线程可能同时触发首次初始化
+_PARSER_LOCK = threading.Lock()
 
 def _make_parser():
+    """Build the parser, recording dots_ocr import and weight load times in _STARTUP_REPORT"""
+    import_start = time.perf_counter()
+    import dots_ocr  # noqa: F401  torch/transformers等重量级依赖在这里加载
+    _STARTUP_REPORT["dots_ocr_import_s"] = round(time.perf_counter() - import_start, 3)
+
+    load_start = time.perf_counter()
+    parser = _construct_parser()
+    _STARTUP_REPORT["weight_load_s"] = round(time.perf_counter() - load_start, 3)
+    return parser
+
+def _construct_parser():
+    if INFERENCE_BACKEND == "openai":
+        # 推理交给OpenAI兼容的推理服务（如vLLM sidecar），parser只负责前后处理，不加载权重
+        from dots_ocr import DotsOCRParser
+        logger.info(f"Initializing DotsOCRParser(use_hf=False) for inference server {OPENAI_BASE_URL}")
+        return DotsOCRParser(use_hf=False)
+
     # 优先用高阶 API（通常 README 推荐）
     try:
         from dots_ocr import DotsOCR
@@ -69,8 +257,68 @@ def _make_parser():
 def _get_parser():
     global _PARSER
     if _PARSER is None:
-        _PARSER = _make_parser()
+        with _PARSER_LOCK:
+            if _PARSER is None:
+                _PARSER = _make_parser()
     return _PARSER
+
+def _warmup_parser(parser):
+    """Run one synthetic page through the model so kernels are compiled before the first job"""
+    from PIL import ImageDraw
+    image = Image.new("RGB", (1024, 768), "white")
+    draw = ImageDraw.Draw(image)
+    lines = ["DotsOCR warmup page", "Invoice No. 2024-001", "Item        Qty    Price", "Total                 42.00"]
+    for i, line in enumerate(lines):
+        draw.text((64, 64 + i * 48), line, fill="black")
+
+    result = _infer_images(parser, [image], "prompt_ocr", ["warmup"], {"size": 1})[0]
+    if isinstance(result, Exception):
+        raise result
+    # 清理warmup产生的输出文件
+    if isinstance(result, list) and result and isinstance(result[0], dict):
+        for key in ("md_content_path", "layout_info_path"):
+            path = result[0].get(key)
+            if path:
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                break
+
+def _initialize_worker():
+    """Eagerly load the model, warm it up and start the render pool before accepting jobs
+
+    Failures are logged and left to the lazy path in _get_parser, so the
+    worker still starts (and reports the error per job) if the model cannot load.
+    """
+    init_start = time.perf_counter()
+    try:
+        parser = _get_parser()
+        if os.getenv("DOTSOCR_WARMUP", "1") == "1":
+            warmup_start = time.perf_counter()
+            _warmup_parser(parser)
+            _STARTUP_REPORT["warmup_s"] = round(time.perf_counter() - warmup_start, 3)
+    except Exception as e:
+        logger.error(f"Eager initialization failed, parser will be loaded on first job: {e}")
+        _STARTUP_REPORT["init_error"] = str(e)
+
+    render_workers = _get_int_option(None, "render_workers", "DOTSOCR_RENDER_WORKERS", 2)
+    if render_workers > 1:
+        # 提前拉起渲染子进程（spawn启动需要重新导入本模块）
+        pool_start = time.perf_counter()
+        pool = _get_render_pool(render_workers)
+        for future in [pool.submit(os.getpid) for _ in range(render_workers)]:
+            future.result()
+        _STARTUP_REPORT["render_pool_s"] = round(time.perf_counter() - pool_start, 3)
+
+    _STARTUP_REPORT["total_s"] = round(time.perf_counter() - _IMPORT_START, 3)
+    _STARTUP_REPORT["eager_init_s"] = round(time.perf_counter() - init_start, 3)
+    logger.info(f"Worker startup breakdown: {_STARTUP_REPORT}")
+
+def _attach_startup_report(response):
+    """Add the cold-start breakdown to the first response this worker returns"""
+    global _STARTUP_REPORTED
+    if not _STARTUP_REPORTED and isinstance(response, dict) and "error" not in response:
+        _STARTUP_REPORTED = True
+        response["startup"] = dict(_STARTUP_REPORT)
+    return response
 # --- end: robust DotsOCR init ---
 
 def handler(event):
@@ -84,7 +332,30 @@ def handler(event):
             "input": {
                 "image_base64": "base64_encoded_image_string",  # for images
                 "pdf_base64": "base64_encoded_pdf_string",      # for PDFs
-                "prompt_type": "layout_parsing"  # optional, defaults to layout_parsing
+                "image_url": "https://...",  # or an http(s)/S3 presigned URL instead of base64
+                "pdf_url": "https://...",    # (exactly one of the four inputs)
+                "prompt_type": "layout_parsing",  # optional, defaults to layout_parsing; also layout_detection, text_only, region_parsing
+                "categories": ["Table", "Text"],  # optional, layout categories recognized by region_parsing (env DOTSOCR_REGION_CATEGORIES)
+                "region_batch_size": 8,  # optional, region crops per generate call on the HF backend, capped by an explicit page_batch_size (env DOTSOCR_REGION_BATCH_SIZE)
+                "render_workers": 2,   # optional, PDF render processes (env DOTSOCR_RENDER_WORKERS)
+                "prefetch_pages": 4,   # optional, max pages rendered ahead (env DOTSOCR_PREFETCH_PAGES)
+                "page_batch_size": 1,  # optional, PDF pages per generate call on the HF backend (env DOTSOCR_PAGE_BATCH_SIZE)
+                "use_cache": true,     # optional, set false to bypass the result cache
+                "image_mode": "keep",  # optional, embedded base64 images: keep | strip | reference (env DOTSOCR_IMAGE_MODE)
+                "compress_response": false,  # optional, return the response as a gzip+base64 envelope
+                "stream": false,             # optional, with DOTSOCR_STREAM=1 yield every PDF page as it is parsed (stream_handler)
+                "text_layer_mode": "off",    # optional, "auto" answers born-digital PDF pages from their text layer, not with region_parsing categories other than Text (env DOTSOCR_TEXT_LAYER_MODE)
+                "output_mode": "inline",     # optional, "spool" writes PDF pages as JSONL to the result store and returns a manifest (env DOTSOCR_OUTPUT_MODE)
+                "result_upload_url": "https://...",  # optional, presigned PUT URL for the spooled JSONL instead of DOTSOCR_RESULT_STORE
+                "page_filter": "off",        # optional, "auto" skips blank pages and reuses results for pixel-identical repeated pages (env DOTSOCR_PAGE_FILTER)
+                "layout_format": "records",  # optional, records | columnar | columnar_packed (int32 base64 bboxes) (env DOTSOCR_LAYOUT_FORMAT)
+                "pixel_budget": 11289600,    # optional, max pixels per rendered page / decoded JPEG (env DOTSOCR_PIXEL_BUDGET)
+                "min_page_pixels": 1000000,  # optional, small pages are rendered up to this many pixels (env DOTSOCR_MIN_PAGE_PIXELS)
+                "raster_color": "auto",      # optional, "auto" renders pages without color content in grayscale, "rgb" always RGB (env DOTSOCR_RASTER_COLOR)
+                "page_range": "1-3,7,10-",   # optional, 1-based PDF pages to process (string or list of page numbers)
+                "max_pages": 0,              # optional, process at most this many of the selected pages, 0 = all (env DOTSOCR_MAX_PAGES)
+                "page_order": "document",    # optional, document | listed (page_range order) | reverse (env DOTSOCR_PAGE_ORDER)
+                "time_budget_s": 0           # optional, stop before this many seconds and return remaining_pages, 0 = no limit (env DOTSOCR_TIME_BUDGET_S)
             }
         }
        
@@ -95,21 +366,22 @@ def handler(event):
     try:
         logger.info("Worker Start - DotsOCR Handler")
         input_data = event['input']
+        _begin_job_metrics(input_data)
         
-        # Get base64 data and determine input type
+        # Get base64 data (or download URL) and determine input type
         image_base64 = input_data.get('image_base64')
         pdf_base64 = input_data.get('pdf_base64')
         prompt_type = input_data.get('prompt_type', 'layout_parsing')
+        input_keys = _input_keys(input_data)
         
-        if not image_base64 and not pdf_base64:
-            return {"error": "No image_base64 or pdf_base64 provided in input"}
+        if not input_keys:
+            return {"error": "No image_base64, pdf_base64, image_url or pdf_url provided in input"}
         
-        if image_base64 and pdf_base64:
-            return {"error": "Both image_base64 and pdf_base64 provided. Please provide only one."}
+        if len(input_keys) > 1:
+            return {"error": f"Multiple inputs provided ({', '.join(input_keys)}). Please provide only one."}
         
         # Determine input type
-        is_pdf = pdf_base64 is not None
-        input_base64 = pdf_base64 if is_pdf else image_base64
+        is_pdf = input_keys[0] in ("pdf_base64", "pdf_url")
         
         logger.info(f"Processing {'PDF' if is_pdf else 'image'} with prompt type: {prompt_type}")
         
@@ -119,12 +391,15 @@ def handler(event):
             parser = _get_parser()
             logger.info("DotsOCR parser initialized successfully!")
             
-            if is_pdf:
-                # Process PDF
-                return process_pdf_with_dotsocr(parser, pdf_base64, prompt_type)
-            else:
-                # Process image
-                return process_image_with_dotsocr(parser, image_base64, prompt_type)
+            # parser输出写到本任务的临时工作目录，任务结束时删除
+            with _job_workspace():
+                if is_pdf:
+                    # Process PDF
+                    response = process_pdf_with_dotsocr(parser, pdf_base64, prompt_type, input_data)
+                else:
+                    # Process image
+                    response = process_image_with_dotsocr(parser, image_base64, prompt_type, input_data)
+            return _finalize_response(response, input_data)
                     
         except ImportError as e:
             logger.error(f"Failed to import DotsOCR: {e}")
@@ -137,6 +412,13 @@ def handler(event):
                     "status": "import_failed",
                     "error": str(e)
                 }
+            elif not image_base64:
+                return {
+                    "markdown": "# Mock OCR Result\n\nDotsOCR import failed: {}\n\nInput type: image URL".format(str(e)),
+                    "layout_data": [{"type": "text", "content": "Mock content"}],
+                    "status": "import_failed",
+                    "error": str(e)
+                }
             else:
                 image_data = base64.b64decode(image_base64)
                 image = Image.open(io.BytesIO(image_data))
@@ -151,111 +433,2301 @@ def handler(event):
         logger.error(f"Error in handler: {str(e)}")
         return {"error": f"Processing failed: {str(e)}"}
 
-def process_pdf_with_dotsocr(parser, pdf_base64, prompt_type):
-    """Process PDF with DotsOCR and return markdown and layout data with multi-page support"""
+def _prompt_mode_for(prompt_type):
+    """Map the public prompt_type to the dots.ocr prompt_mode"""
+    if prompt_type == "layout_detection":
+        # 仅布局检测
+        return "prompt_layout_only_en"
+    if prompt_type == "text_only":
+        # 仅文本识别，排除页眉页脚
+        return "prompt_ocr"
+    # layout_parsing 及默认：解析所有布局信息，包括检测和识别
+    return "prompt_layout_all_en"
+
+def _get_int_option(options, key, env_name, default):
+    """Read an integer setting from the job input, falling back to an env var"""
+    value = (options or {}).get(key)
+    if value is None:
+        value = os.getenv(env_name)
     try:
-        # Decode base64 PDF
-        pdf_bytes = base64.b64decode(pdf_base64)
-        
-        # 使用PyMuPDF打开PDF文档
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        total_pages = len(pdf_document)
-        logger.info(f"PDF opened successfully, total pages: {total_pages}")
-        
-        if total_pages == 0:
-            return {"error": "PDF document has no pages"}
-        
-        # 存储所有页面的结果
-        all_markdown_content = []
-        all_layout_data = []
-        
-        # 逐页处理PDF
-        for page_number in range(total_pages):
-            logger.info(f"Processing page {page_number + 1}/{total_pages}")
-            
+        return int(value) if value is not None else default
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid {key}={value!r}, using default {default}")
+        return default
+
+def _get_float_option(options, key, env_name, default):
+    """Read a float setting from the job input, falling back to an env var"""
+    value = (options or {}).get(key)
+    if value is None:
+        value = os.getenv(env_name)
+    try:
+        return float(value) if value is not None else default
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid {key}={value!r}, using default {default}")
+        return default
+
+def _get_choice_option(options, key, env_name, choices, default):
+    """Read a setting that must be one of choices from the job input, falling back to an env var"""
+    value = (options or {}).get(key) or os.getenv(env_name) or default
+    if value not in choices:
+        logger.warning(f"Unknown {key} {value!r}, using default {default!r}")
+        return default
+    return value
+
+# --- begin: URL input ---
+# pdf_url / image_url（包括S3兼容的预签名URL）：流式下载到本地spool文件，
+# 避免base64膨胀33%、RunPod请求体大小限制，以及base64字符串和解码数据同时驻留内存
+INPUT_KEYS = ("image_base64", "pdf_base64", "image_url", "pdf_url")
+DOWNLOAD_TIMEOUT = float(os.getenv("DOTSOCR_DOWNLOAD_TIMEOUT", "60"))
+DOWNLOAD_RETRIES = int(os.getenv("DOTSOCR_DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOTSOCR_DOWNLOAD_MAX_BYTES", str(1024 * 1024 * 1024)))
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+SPOOL_DIR = os.getenv("DOTSOCR_SPOOL_DIR") or None
+
+# 输入文档：data是内联base64解码后的bytes，path是下载得到的spool文件，二者只有一个
+# sha256在下载时边收边算；内联输入在需要缓存键时才计算
+_InputDocument = collections.namedtuple("_InputDocument", ["data", "path", "sha256"])
+
+_HTTP_SESSION = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+def _input_keys(input_data):
+    """The document inputs present in the job input, in INPUT_KEYS order"""
+    return [key for key in INPUT_KEYS if input_data.get(key)]
+
+def _get_http_session():
+    """Shared requests session: pooled keep-alive connections, retries on connect errors and 429/5xx"""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        with _HTTP_SESSION_LOCK:
+            if _HTTP_SESSION is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                retry = Retry(
+                    total=DOWNLOAD_RETRIES,
+                    backoff_factor=0.5,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset(["GET"])
+                )
+                adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+def _remove_spool(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def _stream_to_file(session, url, path):
+    digest = hashlib.sha256()
+    size = 0
+    with session.get(url, stream=True, timeout=(10, DOWNLOAD_TIMEOUT)) as response:
+        response.raise_for_status()
+        content_length = response.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > DOWNLOAD_MAX_BYTES:
+            raise ValueError(f"Input is {content_length} bytes, larger than the {DOWNLOAD_MAX_BYTES} byte limit")
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > DOWNLOAD_MAX_BYTES:
+                    raise ValueError(f"Input is larger than the {DOWNLOAD_MAX_BYTES} byte limit")
+                digest.update(chunk)
+                f.write(chunk)
+    return size, digest.hexdigest()
+
+def _download_to_spool(url, suffix):
+    """Stream url into a local spool file, returning an _InputDocument
+
+    Connection errors and 429/5xx responses are retried by the session;
+    a transfer cut off mid-body is restarted from the beginning. The caller
+    owns the spool file and removes it with _remove_spool.
+    """
+    import requests
+    if not url.lower().startswith(("http://", "https://")):
+        raise ValueError(f"Unsupported URL (only http and https are supported): {url}")
+
+    session = _get_http_session()
+    fd, path = tempfile.mkstemp(prefix="dotsocr_spool_", suffix=suffix, dir=SPOOL_DIR)
+    os.close(fd)
+    try:
+        with _stage("download"):
+            for attempt in range(DOWNLOAD_RETRIES + 1):
+                try:
+                    size, sha256 = _stream_to_file(session, url, path)
+                    break
+                except requests.exceptions.ChunkedEncodingError as e:
+                    if attempt == DOWNLOAD_RETRIES:
+                        raise
+                    logger.warning(f"Download interrupted ({e}), restarting ({attempt + 1}/{DOWNLOAD_RETRIES})")
+                    time.sleep(0.5 * 2 ** attempt)
+    except Exception:
+        _remove_spool(path)
+        raise
+
+    _add_bytes_in(size)
+    # 预签名URL的查询串里带签名，不写进日志
+    logger.info(f"Downloaded {size} bytes from {url.split('?', 1)[0]}")
+    return _InputDocument(None, path, sha256)
+# --- end: URL input ---
+
+def _open_pdf(pdf_base64, pdf_url=None):
+    """Open the job's PDF with PyMuPDF, returning (_InputDocument, document)
+
+    A pdf_url is downloaded to a spool file that MuPDF reads on demand;
+    inline base64 is decoded into memory. Release both with _close_pdf.
+    """
+    if pdf_url:
+        input_document = _download_to_spool(pdf_url, ".pdf")
+        try:
+            with _stage("pdf_open"):
+                pdf_document = fitz.open(input_document.path)
+        except Exception:
+            _remove_spool(input_document.path)
+            raise
+    else:
+        with _stage("decode"):
+            input_document = _InputDocument(base64.b64decode(pdf_base64), None, None)
+        with _stage("pdf_open"):
+            pdf_document = fitz.open(stream=input_document.data, filetype="pdf")
+    logger.info(f"PDF opened successfully, total pages: {len(pdf_document)}")
+    return input_document, pdf_document
+
+def _close_pdf(input_document, pdf_document):
+    pdf_document.close()
+    if input_document.path:
+        _remove_spool(input_document.path)
+
+# --- begin: pipelined page rasterization ---
+# 将页面转换为图像（推荐DPI 200，根据README建议）
+# 使用更高的DPI以获得更好的识别效果
+PDF_ZOOM_FACTOR = 2.0  # 对应约200 DPI
+# 像素预算：按每页的page.rect计算缩放。超大页面（A3图纸、海报）缩小到模型的输入上限以内，
+# 不再渲染出模型随后又要缩小的巨图；过小的页面（小票、名片）放大，避免文字只有几个像素高。
+# 常规A4/Letter页面仍使用PDF_ZOOM_FACTOR。默认预算为dots.ocr的MAX_PIXELS
+PIXEL_BUDGET = 11289600
+MIN_PAGE_PIXELS = 1000000
+MAX_ZOOM_FACTOR = 4.0
+# 没有彩色内容的页面渲染为灰度：像素数据只有RGB的1/3，渲染和跨进程传输都更快。
+# 颜色由一次低分辨率的探测渲染判断
+RASTER_COLOR_MODES = ("auto", "rgb")
+COLOR_PROBE_ZOOM = 0.25
+COLOR_MIN_CHROMA = 48
+COLOR_MIN_FRACTION = 0.0005
+
+# 渲染进程池：每个子进程持有自己的fitz文档句柄，在GPU推理当前页时提前渲染后续页面
+_RENDER_POOL = None
+_RENDER_POOL_SIZE = 0
+_RENDER_POOL_LOCK = threading.Lock()
+# 子进程内按LRU缓存的文档句柄 doc_key -> fitz.Document；并发模式下共享的进程池会交替渲染
+# 多个任务的页面，只缓存一个句柄会让子进程几乎每页都重新打开PDF
+RENDER_DOC_HANDLES = int(os.getenv("DOTSOCR_RENDER_DOC_HANDLES", "4"))
+_RENDER_DOCS = collections.OrderedDict()
+
+def _raster_color(options=None):
+    return _get_choice_option(options, "raster_color", "DOTSOCR_RASTER_COLOR", RASTER_COLOR_MODES, "auto")
+
+def _raster_settings(options=None):
+    """Rasterization settings that change rendered pixels, part of the document cache key"""
+    pixel_budget = _get_int_option(options, "pixel_budget", "DOTSOCR_PIXEL_BUDGET", PIXEL_BUDGET)
+    if pixel_budget <= 0:
+        logger.warning(f"Invalid pixel_budget={pixel_budget}, using default {PIXEL_BUDGET}")
+        pixel_budget = PIXEL_BUDGET
+    return {
+        "zoom_factor": PDF_ZOOM_FACTOR,
+        "pixel_budget": pixel_budget,
+        "min_pixels": min(pixel_budget, max(0, _get_int_option(options, "min_page_pixels", "DOTSOCR_MIN_PAGE_PIXELS", MIN_PAGE_PIXELS))),
+        "color": _raster_color(options)
+    }
+
+def _page_zoom(rect, settings):
+    """Zoom for a page of the given size (in PDF points) under the raster settings"""
+    zoom = settings["zoom_factor"]
+    area = abs(rect)
+    if not area:
+        return zoom
+    pixels = area * zoom * zoom
+    if pixels > settings["pixel_budget"]:
+        zoom *= math.sqrt(settings["pixel_budget"] / pixels)
+    elif pixels < settings["min_pixels"]:
+        zoom = min(MAX_ZOOM_FACTOR, zoom * math.sqrt(settings["min_pixels"] / pixels))
+    return zoom
+
+def _page_has_color(page):
+    """Whether a low-resolution probe render of the page contains colored pixels"""
+    pix = page.get_pixmap(matrix=fitz.Matrix(COLOR_PROBE_ZOOM, COLOR_PROBE_ZOOM))
+    red, green, blue = Image.frombytes("RGB", [pix.width, pix.height], pix.samples).split()
+    # 色度近似为通道间的最大差值；扫描件的色偏和抗锯齿边缘低于COLOR_MIN_CHROMA
+    chroma = ImageChops.lighter(ImageChops.difference(red, green), ImageChops.difference(green, blue))
+    colored = sum(chroma.histogram()[COLOR_MIN_CHROMA:])
+    return colored > COLOR_MIN_FRACTION * pix.width * pix.height
+
+def _render_page(page, settings):
+    """Rasterize a fitz page under the raster settings (see _raster_settings)
+
+    Returns (pixmap, raster); raster reports the zoom, effective DPI, pixel
+    count and colorspace ("rgb" or "gray") the page was rendered with.
+    """
+    zoom = _page_zoom(page.rect, settings)
+    gray = settings["color"] == "auto" and not _page_has_color(page)
+    mat = fitz.Matrix(zoom, zoom)
+    pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY if gray else fitz.csRGB)
+    raster = {
+        "zoom": round(zoom, 4),
+        "dpi": round(72 * zoom, 1),
+        "pixels": pix.width * pix.height,
+        "colorspace": "gray" if gray else "rgb"
+    }
+    return pix, raster
+
+def _raster_image(width, height, samples, raster):
+    """PIL image for rendered page samples; the raster report travels in image.info"""
+    img = Image.frombytes("L" if raster["colorspace"] == "gray" else "RGB", [width, height], samples)
+    img.info["raster"] = raster
+    return img
+
+def _render_page_in_worker(pdf_path, doc_key, page_index, settings):
+    """Render one page inside a render worker process, reusing its document handles"""
+    pdf_document = _RENDER_DOCS.get(doc_key)
+    if pdf_document is None:
+        pdf_document = _RENDER_DOCS[doc_key] = fitz.open(pdf_path)
+        while len(_RENDER_DOCS) > max(1, RENDER_DOC_HANDLES):
+            _RENDER_DOCS.popitem(last=False)[1].close()
+    else:
+        _RENDER_DOCS.move_to_end(doc_key)
+    pix, raster = _render_page(pdf_document.load_page(page_index), settings)
+    return pix.width, pix.height, pix.samples, raster
+
+def _open_image(fp, settings):
+    """Decode an image input under the pixel budget of the raster settings
+
+    JPEG inputs over the budget are decoded at reduced size (libjpeg DCT
+    scaling by 1/2, 1/4 or 1/8) instead of decoding every pixel only for the
+    model to downscale them. Returns (image, raster); raster["scale"] maps
+    decoded pixels back to the original image (see _scale_layout_bboxes).
+    """
+    image = Image.open(fp)
+    width, height = image.size
+    if image.format == "JPEG" and width * height > settings["pixel_budget"]:
+        # draft选取解码结果不小于请求尺寸的最大缩小比例，剩余的缩放交给模型预处理
+        scale = math.sqrt(settings["pixel_budget"] / (width * height))
+        image.draft(None, (math.ceil(width * scale), math.ceil(height * scale)))
+    image.load()
+    raster = {
+        "original_size": [width, height],
+        "decoded_size": list(image.size),
+        "pixels": image.size[0] * image.size[1],
+        "scale": [width / image.size[0], height / image.size[1]]
+    }
+    dpi = image.info.get("dpi")
+    if dpi and dpi[0]:
+        raster["dpi"] = round(float(dpi[0]) / raster["scale"][0], 1)
+    return image, raster
+
+def _scale_layout_bboxes(layout_data, scale):
+    """Map layout bboxes from decoded image pixels back to the original image"""
+    scale_x, scale_y = scale
+    if scale_x == 1 and scale_y == 1:
+        return
+    for item in layout_data:
+        if isinstance(item, dict) and isinstance(item.get("bbox"), list):
+            item["bbox"] = [
+                int(round(coord * (scale_x if i % 2 == 0 else scale_y)))
+                for i, coord in enumerate(item["bbox"])
+            ]
+
+def _get_render_pool(render_workers):
+    global _RENDER_POOL, _RENDER_POOL_SIZE
+    with _RENDER_POOL_LOCK:
+        if MAX_CONCURRENCY > 1:
+            # 并发模式下进程池由所有任务共享：按DOTSOCR_RENDER_WORKERS只创建一次，
+            # 不随单个请求的render_workers重建，否则会取消其他任务已提交的页面
+            render_workers = max(_get_int_option(None, "render_workers", "DOTSOCR_RENDER_WORKERS", 2), 1)
+            if _RENDER_POOL is not None:
+                return _RENDER_POOL
+        # 只在需要更多进程时重建，避免不同请求的render_workers反复重启进程池
+        if _RENDER_POOL is None or _RENDER_POOL_SIZE < render_workers:
+            if _RENDER_POOL is not None:
+                _RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+            # 使用spawn而不是fork，避免子进程继承父进程里已初始化的CUDA上下文
+            _RENDER_POOL = ProcessPoolExecutor(
+                max_workers=render_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            _RENDER_POOL_SIZE = render_workers
+            logger.info(f"Render pool started with {render_workers} worker processes")
+        return _RENDER_POOL
+
+def _reset_render_pool(pool):
+    """Drop a broken render pool; a pool another job has already replaced it with is kept"""
+    global _RENDER_POOL, _RENDER_POOL_SIZE
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is not pool:
+            return
+        _RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+        _RENDER_POOL = None
+        _RENDER_POOL_SIZE = 0
+
+def _render_inline(pdf_document, page_index, settings):
+    try:
+        with _stage("rasterize"):
+            pix, raster = _render_page(pdf_document.load_page(page_index), settings)
+            # 转换为PIL Image
+            return page_index, _raster_image(pix.width, pix.height, pix.samples, raster), None
+    except Exception as e:
+        return page_index, None, str(e)
+
+def _iter_rendered_pages(pdf_document, input_document, page_indices, render_workers, prefetch_pages, settings):
+    """Yield (page_index, PIL image, render_error) for the given pages, in order
+
+    page_indices is a deque consumed from the left; the caller may keep
+    appending pages while iterating, as long as it only asks for the next
+    item when a page is queued. Pages are rendered under the raster settings
+    (see _raster_settings); each image carries its raster report in
+    image.info["raster"].
+
+    With render_workers > 1 the pages are rendered ahead of the consumer by a
+    pool of worker processes: while the consumer works on a page, up to
+    prefetch_pages queued pages are rendering, which caps memory use.
+    Otherwise pages are rendered inline.
+    """
+    if render_workers <= 1:
+        while page_indices:
+            yield _render_inline(pdf_document, page_indices.popleft(), settings)
+        return
+
+    # 子进程通过文件路径打开文档，避免每个任务都传输整份PDF；URL输入直接复用spool文件
+    if input_document.path:
+        pdf_path = input_document.path
+    else:
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
+            tmp_file.write(input_document.data)
+            pdf_path = tmp_file.name
+    doc_key = uuid.uuid4().hex
+    pool = _get_render_pool(render_workers)
+    remaining = page_indices
+    pending = collections.deque()
+
+    try:
+        while remaining or pending:
+            # 预取深度限制消费者处理当前页期间在途的页面数（当前页出队后还剩prefetch_pages页）
+            while pool is not None and remaining and len(pending) < max(prefetch_pages, 1) + 1:
+                page_index = remaining.popleft()
+                try:
+                    future = pool.submit(_render_page_in_worker, pdf_path, doc_key, page_index, settings)
+                except (BrokenProcessPool, RuntimeError):
+                    remaining.appendleft(page_index)
+                    pool = None
+                    break
+                pending.append((page_index, future))
+
+            if not pending:
+                # 进程池不可用：剩余页面退回到当前进程内渲染
+                yield _render_inline(pdf_document, remaining.popleft(), settings)
+                continue
+
+            page_index, future = pending.popleft()
             try:
-                # 获取当前页面
-                page = pdf_document.load_page(page_number)
-                
-                # 将页面转换为图像（推荐DPI 200，根据README建议）
-                # 使用更高的DPI以获得更好的识别效果
-                zoom_factor = 2.0  # 对应约200 DPI
-                mat = fitz.Matrix(zoom_factor, zoom_factor)
-                pix = page.get_pixmap(matrix=mat)
-                
-                # 转换为PIL Image
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                
-                # 保存页面图像到临时文件
-                with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
-                    img.save(tmp_file.name, 'PNG')
-                    temp_image_path = tmp_file.name
-                
+                # rasterize_wait：消费者等待渲染进程的时间，流水线重叠充分时接近0
+                with _stage("rasterize_wait"):
+                    width, height, samples, raster = future.result()
+                    img = _raster_image(width, height, samples, raster)
+                yield page_index, img, None
+            except BrokenProcessPool:
+                logger.warning("Render pool broken, falling back to inline rendering")
+                _reset_render_pool(pool)
+                pool = None
+                yield _render_inline(pdf_document, page_index, settings)
+            except CancelledError:
+                # 进程池被关闭时取消了已提交的页面：在当前进程内补渲染
+                logger.warning(f"Render of page {page_index + 1} was cancelled, rendering inline")
+                pool = None
+                yield _render_inline(pdf_document, page_index, settings)
+            except Exception as e:
+                yield page_index, None, str(e)
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if not input_document.path and os.path.exists(pdf_path):
+            os.unlink(pdf_path)
+# --- end: pipelined page rasterization ---
+
+# --- begin: per-job scratch workspace ---
+# parser为每页写出markdown、布局JSON和图片；这些文件写到每个任务独立的临时目录，
+# 读取后立即删除，任务结束时整体清理。有足够空间的tmpfs（/dev/shm）时放在内存盘上
+SCRATCH_QUOTA_BYTES = int(os.getenv("DOTSOCR_SCRATCH_QUOTA_BYTES", str(256 * 1024 * 1024)))
+_JOB_WORKSPACE = contextvars.ContextVar("dotsocr_job_workspace", default=None)
+_SCRATCH_ROOT = None
+
+class _ScratchQuotaExceeded(RuntimeError):
+    pass
+
+def _scratch_root():
+    """DOTSOCR_SCRATCH_DIR, else /dev/shm if it has room for every concurrent job's quota, else the temp dir"""
+    global _SCRATCH_ROOT
+    if _SCRATCH_ROOT is None:
+        root = os.getenv("DOTSOCR_SCRATCH_DIR")
+        if not root:
+            root = tempfile.gettempdir()
+            try:
+                # Docker默认的/dev/shm只有64MB，空间不够时不要用
+                if os.access("/dev/shm", os.W_OK) and shutil.disk_usage("/dev/shm").free >= SCRATCH_QUOTA_BYTES * max(1, MAX_CONCURRENCY):
+                    root = "/dev/shm"
+            except OSError:
+                pass
+        _SCRATCH_ROOT = root
+        logger.info(f"Job scratch workspaces under {root} (quota {SCRATCH_QUOTA_BYTES} bytes)")
+    return _SCRATCH_ROOT
+
+@contextlib.contextmanager
+def _job_workspace():
+    """Give the current job its own scratch directory for parser output, removed when the job ends"""
+    path = tempfile.mkdtemp(prefix="dotsocr_job_", dir=_scratch_root())
+    # 与_JOB_METRICS一样用set而不是reset：生成器可能在另一个context里被关闭
+    _JOB_WORKSPACE.set(path)
+    try:
+        yield path
+    finally:
+        _JOB_WORKSPACE.set(None)
+        shutil.rmtree(path, ignore_errors=True)
+
+def _output_dir_for(parser, output_dir=None):
+    """Where parser output goes: the given directory, the job workspace, or the parser's output_dir"""
+    return output_dir or _JOB_WORKSPACE.get() or os.path.abspath(getattr(parser, "output_dir", None) or "./output")
+
+def _check_scratch_quota():
+    """Fail the job when its workspace holds more than DOTSOCR_SCRATCH_QUOTA_BYTES"""
+    workspace = _JOB_WORKSPACE.get()
+    if workspace is None:
+        return
+    used = 0
+    for dir_path, _, file_names in os.walk(workspace):
+        for file_name in file_names:
+            try:
+                used += os.stat(os.path.join(dir_path, file_name)).st_size
+            except OSError:
+                pass
+    if used > SCRATCH_QUOTA_BYTES:
+        raise _ScratchQuotaExceeded(f"Scratch workspace quota exceeded: {used} > {SCRATCH_QUOTA_BYTES} bytes")
+
+def _read_result_files(first_result):
+    """Read a parse result's markdown and layout JSON with one listing of its output directory
+
+    Returns (markdown, layout); either is None when the result has no such
+    file. Output directories inside the job workspace are removed once read.
+    """
+    paths = {key: first_result.get(key) for key in ("md_content_path", "layout_info_path") if first_result.get(key)}
+    if not paths:
+        return None, None
+
+    save_dirs = {os.path.dirname(path) for path in paths.values()}
+    existing = set()
+    for save_dir in save_dirs:
+        try:
+            existing.update(os.path.normpath(entry.path) for entry in os.scandir(save_dir) if entry.is_file())
+        except OSError:
+            pass
+
+    contents = {}
+    for key, path in paths.items():
+        if os.path.normpath(path) not in existing:
+            logger.warning(f"Result file not found: {path}")
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            contents[key] = f.read()
+
+    workspace = _JOB_WORKSPACE.get()
+    if workspace:
+        for save_dir in save_dirs:
+            if os.path.abspath(save_dir).startswith(os.path.abspath(workspace) + os.sep):
+                shutil.rmtree(save_dir, ignore_errors=True)
+
+    layout = json.loads(contents["layout_info_path"]) if "layout_info_path" in contents else None
+    return contents.get("md_content_path"), layout
+
+def _move_output_to_workspace(result, workspace):
+    """Move parse_file output written to the parser's own output directory into the job workspace
+
+    The result's paths are rewritten, so the output is read and removed
+    by _read_result_files like any other output in the workspace.
+    """
+    if not isinstance(result, list):
+        return result
+    moved = {}
+    for item in result:
+        if not isinstance(item, dict):
+            continue
+        for key in ("md_content_path", "layout_info_path"):
+            path = item.get(key)
+            if not path:
+                continue
+            save_dir = os.path.dirname(os.path.abspath(path))
+            if save_dir not in moved and os.path.isdir(save_dir):
+                target = os.path.join(workspace, f"{os.path.basename(save_dir)}_{uuid.uuid4().hex[:8]}")
+                shutil.move(save_dir, target)
+                moved[save_dir] = target
+        for key, value in item.items():
+            if isinstance(value, str):
+                for save_dir, target in moved.items():
+                    if os.path.abspath(value).startswith(save_dir + os.sep):
+                        item[key] = os.path.join(target, os.path.relpath(os.path.abspath(value), save_dir))
+                        break
+    return result
+# --- end: per-job scratch workspace ---
+
+# --- begin: in-memory parser input ---
+# None表示尚未探测；探测一次后缓存结果
+_INMEMORY_INPUT_SUPPORTED = None
+_PARSE_FILE_OUTPUT_DIR_SUPPORTED = None
+
+def _supports_inmemory_input(parser):
+    """Check once whether the parser exposes DotsOCRParser._parse_single_image"""
+    global _INMEMORY_INPUT_SUPPORTED
+    if os.getenv("DOTSOCR_INMEMORY_INPUT", "1") != "1":
+        return False
+    if _INMEMORY_INPUT_SUPPORTED is None:
+        parse_single_image = getattr(parser, "_parse_single_image", None)
+        supported = False
+        if callable(parse_single_image):
+            try:
+                sig = inspect.signature(parse_single_image)
+                supported = all(key in sig.parameters for key in ("origin_image", "prompt_mode", "save_dir", "save_name"))
+            except (TypeError, ValueError):
+                supported = False
+        logger.info(f"In-memory parser input supported: {supported}")
+        _INMEMORY_INPUT_SUPPORTED = supported
+    return _INMEMORY_INPUT_SUPPORTED
+
+def _parse_file_accepts_output_dir(parser):
+    """Check once whether parser.parse_file takes an output_dir argument"""
+    global _PARSE_FILE_OUTPUT_DIR_SUPPORTED
+    if _PARSE_FILE_OUTPUT_DIR_SUPPORTED is None:
+        try:
+            params = inspect.signature(parser.parse_file).parameters
+            supported = "output_dir" in params or any(p.kind == inspect.Parameter.VAR_KEYWORD for p in params.values())
+        except (TypeError, ValueError):
+            supported = False
+        logger.info(f"parse_file output_dir supported: {supported}")
+        _PARSE_FILE_OUTPUT_DIR_SUPPORTED = supported
+    return _PARSE_FILE_OUTPUT_DIR_SUPPORTED
+
+def _parse_image(parser, image, prompt_mode, save_name, output_dir=None):
+    """Run DotsOCR on a PIL image and return the parse_file style result list
+
+    The decoded image is handed straight to the parser when it supports it,
+    skipping the PNG encode / temp file / decode round trip. Parsers that only
+    accept paths fall back to a temporary PNG file. Output is written under
+    output_dir, by default the current job's workspace (see _output_dir_for);
+    a parse_file without an output_dir argument writes to its own output
+    directory, and that output is moved into the workspace.
+    """
+    global _INMEMORY_INPUT_SUPPORTED
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    if _supports_inmemory_input(parser):
+        # 与parse_file相同的输出目录布局：<output_dir>/<save_name>/
+        save_name = f"{save_name}_{uuid.uuid4().hex[:8]}"
+        save_dir = os.path.join(_output_dir_for(parser, output_dir), save_name)
+        os.makedirs(save_dir, exist_ok=True)
+        try:
+            return [parser._parse_single_image(image, prompt_mode, save_dir, save_name, source="image")]
+        except TypeError as e:
+            # 旧版本parser参数不兼容，之后都走文件路径
+            shutil.rmtree(save_dir, ignore_errors=True)
+            logger.warning(f"In-memory parser input failed ({e}), falling back to file input")
+            _INMEMORY_INPUT_SUPPORTED = False
+        except Exception:
+            # 失败的解析不留下空的输出目录（warmup等任务之外的调用写在parser.output_dir下）
+            shutil.rmtree(save_dir, ignore_errors=True)
+            raise
+
+    # 保存图像到临时文件（任务进行中时放在任务的工作目录里）
+    workspace = output_dir or _JOB_WORKSPACE.get()
+    with _stage("image_encode"), tempfile.NamedTemporaryFile(suffix='.png', delete=False, dir=workspace) as tmp_file:
+        image.save(tmp_file.name, 'PNG')
+        temp_image_path = tmp_file.name
+
+    try:
+        if not workspace:
+            return parser.parse_file(temp_image_path, prompt_mode=prompt_mode)
+        if _parse_file_accepts_output_dir(parser):
+            return parser.parse_file(temp_image_path, output_dir=workspace, prompt_mode=prompt_mode)
+        return _move_output_to_workspace(parser.parse_file(temp_image_path, prompt_mode=prompt_mode), workspace)
+    finally:
+        # 清理临时图像文件
+        if os.path.exists(temp_image_path):
+            os.unlink(temp_image_path)
+# --- end: in-memory parser input ---
+
+# --- begin: batched HF page inference ---
+class _PendingModelCall:
+    """One image's parse inside _parse_images_batch, paused at its model call"""
+    def __init__(self):
+        self.image = None
+        self.prompt = None
+        self.captured = False
+        # 模型输入已就绪，或者解析已结束（没有调用模型）时置位
+        self.ready = threading.Event()
+        self.response = Future()
+        self.result = None
+
+# 解析线程当前对应的_PendingModelCall
+_BATCH_CALL = threading.local()
+
+def _supports_hf_batching(parser):
+    """Batched generate needs the in-process HF backend (use_hf=True) and its model/processor"""
+    return (
+        getattr(parser, "use_hf", False)
+        and _supports_inmemory_input(parser)
+        and all(hasattr(parser, attr) for attr in ("model", "processor", "process_vision_info"))
+    )
+
+def _is_oom_error(e):
+    return type(e).__name__ == "OutOfMemoryError" or "out of memory" in str(e).lower()
+
+def _empty_cuda_cache():
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+def _hf_generate_batch(parser, images, prompts):
+    """Batched version of DotsOCRParser._inference_with_hf: one generate call for all images"""
+    messages_batch = [
+        [{"role": "user", "content": [{"type": "image", "image": image}, {"type": "text", "text": prompt}]}]
+        for image, prompt in zip(images, prompts)
+    ]
+    texts = [
+        parser.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        for messages in messages_batch
+    ]
+    image_inputs, video_inputs = parser.process_vision_info(messages_batch)
+    # decoder-only模型批量生成需要左侧padding，这样所有输出都从同一位置开始
+    parser.processor.tokenizer.padding_side = "left"
+    inputs = parser.processor(text=texts, images=image_inputs, videos=video_inputs, padding=True, return_tensors="pt")
+    inputs = inputs.to(parser.model.device)
+    generated_ids = parser.model.generate(**inputs, max_new_tokens=24000)
+    generated_ids_trimmed = [out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
+    return parser.processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+@contextlib.contextmanager
+def _inference_hook(parser, hook):
+    """Temporarily replace the parser's model call with hook(model_image, prompt)
+
+    The model call is _inference_with_hf on the HF backend and
+    _inference_with_vllm (the server client) otherwise.
+    """
+    attr = "_inference_with_hf" if getattr(parser, "use_hf", False) else "_inference_with_vllm"
+    original = parser.__dict__.get(attr)
+    setattr(parser, attr, hook)
+    try:
+        yield
+    finally:
+        if original is None:
+            parser.__dict__.pop(attr, None)
+        else:
+            setattr(parser, attr, original)
+
+def _parse_images_batch(parser, images, prompt_mode, save_names, batch_state, output_dirs=None):
+    """Parse several images with batched HF generate calls (or concurrent server requests)
+
+    The parser's own preprocessing (resize, prompt) and postprocessing (cells,
+    markdown, output files) are reused unchanged: every image is parsed in
+    its own thread, which pauses at the model call until the batched
+    response for its input is ready. The captured inputs are generated in
+    batches of batch_state["size"]. When a batch runs out of GPU memory,
+    batch_state["size"] is halved and the batch retried. With the openai
+    backend all captured inputs are sent to the inference server at once,
+    bounded by DOTSOCR_OPENAI_CONCURRENCY.
+    Returns one parse_file style result or Exception per image.
+    output_dirs gives each image's output directory (default: _output_dir_for).
+    """
+    output_dirs = output_dirs or [None] * len(images)
+    attr = "_inference_with_hf" if getattr(parser, "use_hf", False) else "_inference_with_vllm"
+    default_inference = getattr(parser, attr, None)
+
+    def hook(model_image, prompt):
+        call = getattr(_BATCH_CALL, "pending", None)
+        if call is None:
+            # 不属于本批次的线程照常调用模型
+            return default_inference(model_image, prompt)
+        call.image, call.prompt, call.captured = model_image, prompt, True
+        call.ready.set()
+        return call.response.result()
+
+    def parse(call, image, save_name, output_dir):
+        _BATCH_CALL.pending = call
+        try:
+            call.result = _parse_image(parser, image, prompt_mode, save_name, output_dir)
+        except Exception as e:
+            call.result = e
+        finally:
+            _BATCH_CALL.pending = None
+            call.ready.set()
+
+    calls = [_PendingModelCall() for _ in images]
+    threads = []
+    with _inference_hook(parser, hook):
+        try:
+            for call, image, save_name, output_dir in zip(calls, images, save_names, output_dirs):
+                # 每个线程复制当前context，计时器和任务工作目录在解析线程里同样可见
+                context = contextvars.copy_context()
+                thread = threading.Thread(target=context.run, args=(parse, call, image, save_name, output_dir), name="dotsocr-parse", daemon=True)
+                thread.start()
+                threads.append(thread)
+            for call in calls:
+                call.ready.wait()
+
+            todo = [i for i, call in enumerate(calls) if call.captured]
+            pos = 0
+            while pos < len(todo):
+                if INFERENCE_BACKEND == "openai":
+                    chunk = todo[pos:]
+                else:
+                    chunk = todo[pos:pos + batch_state["size"]]
                 try:
-                    # 使用DotsOCR处理当前页面图像
-                    logger.info(f"Processing page {page_number + 1} image with DotsOCR...")
-                    
-                    # 根据README指示，使用正确的解析方法
-                    if prompt_type == "layout_parsing":
-                        # 解析所有布局信息，包括检测和识别
-                        page_result = parser.parse_file(temp_image_path, prompt_mode="prompt_layout_all_en")
-                    elif prompt_type == "layout_detection":
-                        # 仅布局检测
-                        page_result = parser.parse_file(temp_image_path, prompt_mode="prompt_layout_only_en")
-                    elif prompt_type == "text_only":
-                        # 仅文本识别，排除页眉页脚
-                        page_result = parser.parse_file(temp_image_path, prompt_mode="prompt_ocr")
+                    generate = _openai_generate_batch if INFERENCE_BACKEND == "openai" else _hf_generate_batch
+                    outputs = generate(parser, [calls[i].image for i in chunk], [calls[i].prompt for i in chunk])
+                except Exception as e:
+                    if _is_oom_error(e) and len(chunk) > 1:
+                        # 显存不足：减半batch后重试
+                        batch_state["size"] = max(1, len(chunk) // 2)
+                        logger.warning(f"OOM with page batch of {len(chunk)}, retrying with batch size {batch_state['size']}")
+                        _empty_cuda_cache()
+                        continue
+                    if len(chunk) > 1:
+                        # 合并的batch可能包含其他任务的页面：逐张重试，只让真正出错的图片失败
+                        logger.warning(f"Batched inference of {len(chunk)} images failed ({e}), retrying one at a time")
+                        outputs = []
+                        for i in chunk:
+                            try:
+                                outputs.extend(generate(parser, [calls[i].image], [calls[i].prompt]))
+                            except Exception as single_error:
+                                logger.error(f"Inference failed: {single_error}")
+                                outputs.append(single_error)
                     else:
-                        # 默认使用布局解析
-                        page_result = parser.parse_file(temp_image_path, prompt_mode="prompt_layout_all_en")
-                    
-                    # 处理当前页面的结果
-                    page_markdown, page_layout = extract_content_from_result(page_result, page_number + 1)
-                    
-                    # 添加页面标题
-                    page_header = f"\n\n## Page {page_number + 1}\n\n"
-                    all_markdown_content.append(page_header + page_markdown)
-                    all_layout_data.extend(page_layout)
-                    
-                    logger.info(f"Page {page_number + 1} processed successfully")
-                    
-                finally:
-                    # 清理临时图像文件
-                    if os.path.exists(temp_image_path):
-                        os.unlink(temp_image_path)
-                        
+                        logger.error(f"Batched inference failed: {e}")
+                        outputs = [e]
+                for i, output in zip(chunk, outputs):
+                    if isinstance(output, Exception):
+                        calls[i].response.set_exception(output)
+                    else:
+                        calls[i].response.set_result(output)
+                pos += len(chunk)
+        finally:
+            # 任何情况下都不能让解析线程一直等待
+            for call in calls:
+                if not call.response.done():
+                    call.response.set_exception(RuntimeError("Batched inference did not run"))
+            for thread in threads:
+                thread.join()
+    return [call.result for call in calls]
+# --- end: batched HF page inference ---
+
+# --- begin: OpenAI-compatible server backend ---
+# DOTSOCR_BACKEND=openai：页面发送到OpenAI兼容的推理服务（如vLLM sidecar，服务端做continuous batching），
+# 通过共享的异步HTTP连接池并发请求，同一文档的多页同时在途
+INFERENCE_BACKEND = os.getenv("DOTSOCR_BACKEND", "hf")
+OPENAI_BASE_URL = os.getenv("DOTSOCR_OPENAI_BASE_URL", "http://127.0.0.1:8000/v1")
+OPENAI_MODEL = os.getenv("DOTSOCR_OPENAI_MODEL", "model")
+OPENAI_API_KEY = os.getenv("DOTSOCR_OPENAI_API_KEY", "")
+OPENAI_CONCURRENCY = int(os.getenv("DOTSOCR_OPENAI_CONCURRENCY", "8"))
+OPENAI_TIMEOUT = float(os.getenv("DOTSOCR_OPENAI_TIMEOUT", "300"))
+OPENAI_RETRIES = int(os.getenv("DOTSOCR_OPENAI_RETRIES", "3"))
+# 与dots.ocr的vLLM推理默认值一致
+OPENAI_MAX_TOKENS = int(os.getenv("DOTSOCR_OPENAI_MAX_TOKENS", "16384"))
+# dots.ocr的vLLM聊天模板要求的图像占位前缀
+_OPENAI_IMAGE_PREFIX = "<|img|><|imgpad|><|endofimg|>"
+
+# 后台事件循环线程持有连接池，所有任务线程共享
+_OPENAI_LOOP = None
+_OPENAI_CLIENT = None
+_OPENAI_SEMAPHORE = None
+_OPENAI_LOCK = threading.Lock()
+
+def _openai_loop():
+    """Start (once) the event loop thread that owns the pooled httpx.AsyncClient"""
+    global _OPENAI_LOOP, _OPENAI_CLIENT, _OPENAI_SEMAPHORE
+    if _OPENAI_LOOP is None:
+        with _OPENAI_LOCK:
+            if _OPENAI_LOOP is None:
+                import httpx
+                # httpx每个请求都打INFO日志，多页文档会刷屏
+                logging.getLogger("httpx").setLevel(logging.WARNING)
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="dotsocr-openai", daemon=True).start()
+
+                async def create_client():
+                    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"} if OPENAI_API_KEY else {}
+                    client = httpx.AsyncClient(
+                        base_url=OPENAI_BASE_URL,
+                        headers=headers,
+                        limits=httpx.Limits(max_connections=OPENAI_CONCURRENCY, max_keepalive_connections=OPENAI_CONCURRENCY),
+                        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0, pool=None)
+                    )
+                    return client, asyncio.Semaphore(max(1, OPENAI_CONCURRENCY))
+
+                _OPENAI_CLIENT, _OPENAI_SEMAPHORE = asyncio.run_coroutine_threadsafe(create_client(), loop).result()
+                _OPENAI_LOOP = loop
+                logger.info(f"Inference server client started: {OPENAI_BASE_URL}, concurrency={OPENAI_CONCURRENCY}")
+    return _OPENAI_LOOP
+
+def _image_data_url(image):
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+async def _openai_chat_completion(payload):
+    """POST one chat completion, retrying connection errors, timeouts, 429 and 5xx"""
+    import httpx
+    async with _OPENAI_SEMAPHORE:
+        for attempt in range(OPENAI_RETRIES + 1):
+            try:
+                response = await _OPENAI_CLIENT.post("chat/completions", json=payload)
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()["choices"][0]["message"]["content"]
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+            if attempt == OPENAI_RETRIES:
+                raise RuntimeError(f"Inference server request failed after {attempt + 1} attempts: {error}")
+            logger.warning(f"Inference server request failed ({error}), retrying ({attempt + 1}/{OPENAI_RETRIES})")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+def _openai_generate_batch(parser, images, prompts):
+    """Send every image to the inference server concurrently, returning one response text or Exception each"""
+    loop = _openai_loop()
+    with _stage("image_encode"):
+        data_urls = [_image_data_url(image) for image in images]
+    payloads = [
+        {
+            "model": OPENAI_MODEL,
+            "messages": [{"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": data_url}},
+                {"type": "text", "text": f"{_OPENAI_IMAGE_PREFIX}{prompt}"}
+            ]}],
+            "max_tokens": OPENAI_MAX_TOKENS,
+            "temperature": getattr(parser, "temperature", 0.1),
+            "top_p": getattr(parser, "top_p", 0.9)
+        }
+        for data_url, prompt in zip(data_urls, prompts)
+    ]
+
+    async def run_all():
+        return await asyncio.gather(*[_openai_chat_completion(payload) for payload in payloads], return_exceptions=True)
+
+    return asyncio.run_coroutine_threadsafe(run_all(), loop).result()
+
+def _use_batched_inference(parser, count):
+    """Whether count images go through _parse_images_batch instead of one _parse_image call each"""
+    if INFERENCE_BACKEND == "openai":
+        # 服务端推理总是走共享连接池（带超时和重试），单页也一样
+        return True
+    return count > 1 and _supports_hf_batching(parser)
+# --- end: OpenAI-compatible server backend ---
+
+# --- begin: cross-request batching scheduler ---
+# 并发模式（DOTSOCR_CONCURRENCY > 1）下，多个任务的页面由同一个调度线程合并成micro-batch推理
+MAX_CONCURRENCY = int(os.getenv("DOTSOCR_CONCURRENCY", "1"))
+MAX_BATCH_SIZE = int(os.getenv("DOTSOCR_MAX_BATCH_SIZE", "4"))
+MAX_BATCH_WAIT_MS = float(os.getenv("DOTSOCR_MAX_BATCH_WAIT_MS", "20"))
+# OOM后batch被减半；连续这么多个满batch成功后再翻倍，逐步恢复到max_batch_size
+BATCH_REGROW_AFTER = int(os.getenv("DOTSOCR_BATCH_REGROW_AFTER", "16"))
+
+_SCHEDULER = None
+
+class _InferenceScheduler:
+    """Single owner of the parser that merges pages from concurrent jobs into micro-batches
+
+    Job threads submit images and wait on the returned futures. The scheduler
+    thread takes the first waiting request, collects more for up to
+    max_wait_ms or until max_batch_size is reached, groups them by
+    prompt_mode and runs each group as one batch. Every request gets its own
+    result or exception, so a failing page only affects its own job.
+    The batch size halved after an OOM is doubled again after
+    BATCH_REGROW_AFTER full batches in a row succeed, up to max_batch_size.
+    """
+
+    def __init__(self, max_batch_size, max_wait_ms):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        # OOM时由_parse_images_batch缩小，由_regrow_batch恢复
+        self._batch_state = {"size": self.max_batch_size}
+        self._full_batches = 0
+        self._thread = threading.Thread(target=self._run, name="dotsocr-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, image, prompt_mode, save_name, output_dir=None):
+        future = Future()
+        self._queue.put((image, prompt_mode, save_name, output_dir, future))
+        return future
+
+    def _collect(self):
+        requests = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(requests) < self._batch_state["size"]:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            try:
+                parser = _get_parser()
             except Exception as e:
-                logger.error(f"Error processing page {page_number + 1}: {str(e)}")
-                # 继续处理下一页，但记录错误
-                error_content = f"\n\n## Page {page_number + 1} - Processing Error\n\nError: {str(e)}\n\n"
-                all_markdown_content.append(error_content)
-        
-        # 关闭PDF文档
-        pdf_document.close()
-        
-        # 合并所有页面的内容
-        combined_markdown = "".join(all_markdown_content)
-        combined_layout = all_layout_data
-        
-        logger.info(f"PDF processing completed. Total pages: {total_pages}")
-        logger.info(f"Final markdown length: {len(combined_markdown)}")
-        logger.info(f"Final layout data items: {len(combined_layout)}")
-        
+                for request in requests:
+                    request[4].set_exception(e)
+                continue
+
+            groups = collections.OrderedDict()
+            for request in requests:
+                groups.setdefault(request[1], []).append(request)
+            for prompt_mode, group in groups.items():
+                self._run_group(parser, prompt_mode, group)
+
+    def _run_group(self, parser, prompt_mode, group):
+        images = [request[0] for request in group]
+        save_names = [request[2] for request in group]
+        # 每个任务的输出写到各自的工作目录（调度线程里拿不到任务的context）
+        output_dirs = [request[3] for request in group]
+        logger.info(f"Scheduler running a batch of {len(group)} page(s) with {prompt_mode}")
+        if _use_batched_inference(parser, len(group)):
+            batch_size = self._batch_state["size"]
+            try:
+                results = _parse_images_batch(parser, images, prompt_mode, save_names, self._batch_state, output_dirs)
+            except Exception as e:
+                results = [e] * len(group)
+            self._regrow_batch(batch_size, len(group))
+        else:
+            results = []
+            for image, save_name, output_dir in zip(images, save_names, output_dirs):
+                try:
+                    results.append(_parse_image(parser, image, prompt_mode, save_name, output_dir))
+                except Exception as e:
+                    results.append(e)
+
+        for request, result in zip(group, results):
+            if isinstance(result, Exception):
+                request[4].set_exception(result)
+            else:
+                request[4].set_result(result)
+
+    def _regrow_batch(self, batch_size, group_size):
+        """Count full batches that ran without OOM at a reduced batch size, doubling it after a run of them"""
+        if self._batch_state["size"] < batch_size:
+            # 本batch发生了OOM
+            self._full_batches = 0
+            return
+        if batch_size >= self.max_batch_size or group_size < batch_size:
+            return
+        self._full_batches += 1
+        if self._full_batches >= BATCH_REGROW_AFTER:
+            self._batch_state["size"] = min(self.max_batch_size, batch_size * 2)
+            self._full_batches = 0
+            logger.info(f"{BATCH_REGROW_AFTER} batches of {batch_size} without OOM, batch size back to {self._batch_state['size']}")
+
+def _start_scheduler():
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        _SCHEDULER = _InferenceScheduler(MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS)
+        logger.info(f"Inference scheduler started: max_batch_size={MAX_BATCH_SIZE}, max_wait_ms={MAX_BATCH_WAIT_MS}")
+    return _SCHEDULER
+
+def _infer_images(parser, images, prompt_mode, save_names, batch_state):
+    """Run DotsOCR on images, returning one parse_file style result or Exception per image
+
+    Goes through the shared scheduler when it is running, otherwise parses
+    in the calling thread (batched on the HF backend when several images
+    are given).
+    """
+    if _SCHEDULER is not None:
+        workspace = _JOB_WORKSPACE.get()
+        futures = [_SCHEDULER.submit(image, prompt_mode, save_name, workspace) for image, save_name in zip(images, save_names)]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+    elif _use_batched_inference(parser, len(images)):
+        results = _parse_images_batch(parser, images, prompt_mode, save_names, batch_state)
+    else:
+        results = []
+        for image, save_name in zip(images, save_names):
+            try:
+                results.append(_parse_image(parser, image, prompt_mode, save_name))
+            except Exception as e:
+                results.append(e)
+    _check_scratch_quota()
+    return results
+
+def concurrency_modifier(current_concurrency):
+    """RunPod concurrency_modifier: accept up to DOTSOCR_CONCURRENCY jobs at once"""
+    return max(1, MAX_CONCURRENCY)
+
+async def async_handler(event):
+    """Async wrapper so RunPod can run several jobs concurrently; inference is serialized by the scheduler"""
+    return await asyncio.to_thread(handler, event)
+
+async def async_stream_handler(event):
+    """Async generator variant of stream_handler for concurrent streaming workers"""
+    results = stream_handler(event)
+    done = object()
+    # 所有next()在同一个context里运行，任务的计时器和工作目录在各页之间保持不变
+    context = contextvars.copy_context()
+    while True:
+        item = await asyncio.to_thread(context.run, next, results, done)
+        if item is done:
+            break
+        yield item
+# --- end: cross-request batching scheduler ---
+
+# --- begin: output compaction ---
+# dots.ocr会把图片区域以base64内嵌到markdown里，单页可达数百KB
+IMAGE_MODES = ("keep", "strip", "reference")
+_DATA_URI_IMAGE_RE = re.compile(r'!\[([^\]]*)\]\(data:(image/[\w.+-]+);base64,([A-Za-z0-9+/=\s]+)\)')
+
+def _image_mode(options=None):
+    return _get_choice_option(options, "image_mode", "DOTSOCR_IMAGE_MODE", IMAGE_MODES, "keep")
+
+def _compact_markdown(markdown_content, image_mode, image_table=None):
+    """Strip embedded base64 images, or move them into image_table and leave image:// references
+
+    image_table maps a content hash to {"mime_type", "data"}, so an image that
+    appears several times is only stored once.
+    """
+    if image_mode == "keep" or not isinstance(markdown_content, str) or "base64," not in markdown_content:
+        return markdown_content
+
+    def replace(match):
+        if image_mode == "strip":
+            return ""
+        alt_text, mime_type, data = match.groups()
+        data = re.sub(r'\s+', '', data)
+        image_id = hashlib.sha256(data.encode("ascii")).hexdigest()[:16]
+        if image_table is not None and image_id not in image_table:
+            image_table[image_id] = {"mime_type": mime_type, "data": data}
+        return f"![{alt_text}](image://{image_id})"
+
+    return _DATA_URI_IMAGE_RE.sub(replace, markdown_content)
+
+# layout_data格式：records为默认的逐元素字典列表；columnar为按列存储，
+# columnar_packed另外把bbox打包为小端int32的base64
+LAYOUT_FORMATS = ("records", "columnar", "columnar_packed")
+_LAYOUT_COLUMN_KEYS = ("bbox", "category", "text", "page_number")
+
+def _layout_format(options=None):
+    return _get_choice_option(options, "layout_format", "DOTSOCR_LAYOUT_FORMAT", LAYOUT_FORMATS, "records")
+
+def _columnar_layout(layout_data, packed=False):
+    """Convert per-element layout dicts into parallel columns
+
+    category holds codes into the shared categories list (-1 when absent),
+    bbox is a flat x0, y0, x1, y1 sequence (-1s when absent), text is null
+    for elements without text, and pages lists [page_number, count] runs in
+    element order. Keys other than the column keys are kept in extra, which
+    is only present when some element has them.
+    """
+    categories = {}
+    category_codes = []
+    bboxes = []
+    texts = []
+    extras = []
+    page_runs = []
+
+    for item in layout_data:
+        if not isinstance(item, dict):
+            item = {"value": item}
+        category = item.get("category")
+        if category is None:
+            category_codes.append(-1)
+        else:
+            category_codes.append(categories.setdefault(category, len(categories)))
+
+        bbox = item.get("bbox")
+        if isinstance(bbox, (list, tuple)) and len(bbox) == 4:
+            bboxes.extend(int(round(coord)) for coord in bbox)
+        else:
+            bboxes.extend((-1, -1, -1, -1))
+        texts.append(item.get("text"))
+
+        # 没有page_number的元素（单张图片）视为第1页
+        page_number = item.get("page_number", 1)
+        if page_runs and page_runs[-1][0] == page_number:
+            page_runs[-1][1] += 1
+        else:
+            page_runs.append([page_number, 1])
+
+        extra = {key: value for key, value in item.items() if key not in _LAYOUT_COLUMN_KEYS}
+        extras.append(extra or None)
+
+    if packed:
+        packed_bboxes = array.array("i", bboxes)
+        if sys.byteorder == "big":
+            packed_bboxes.byteswap()
+        bbox_column = {"dtype": "int32", "byteorder": "little", "shape": [len(texts), 4], "data": base64.b64encode(packed_bboxes.tobytes()).decode("ascii")}
+    else:
+        bbox_column = bboxes
+
+    columns = {
+        "format": "columnar",
+        "count": len(texts),
+        "categories": list(categories),
+        "category": category_codes,
+        "bbox": bbox_column,
+        "text": texts,
+        "pages": page_runs
+    }
+    if any(extra is not None for extra in extras):
+        columns["extra"] = extras
+    return columns
+
+def _apply_layout_format(response, options=None):
+    layout_format = _layout_format(options)
+    if layout_format == "records" or not isinstance(response, dict) or not isinstance(response.get("layout_data"), list):
+        return response
+    with _stage("layout_encode"):
+        response["layout_data"] = _columnar_layout(response["layout_data"], packed=layout_format == "columnar_packed")
+    return response
+
+def _finalize_response(response, options=None):
+    """Last step for every handler response: layout format, startup report, optional gzip envelope, then timings
+
+    The timings block is added after encoding, so a gzip envelope carries it
+    next to the compressed data and bytes_out measures the envelope.
+    """
+    return _attach_timings(_encode_response(_attach_startup_report(_apply_layout_format(response, options)), options))
+
+def _encode_response(response, options=None):
+    """Wrap a successful response in a gzip+base64 envelope when compress_response is set"""
+    if not (options or {}).get("compress_response") or "error" in response:
+        return response
+    with _stage("compress"):
+        payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        compressed = gzip.compress(payload, compresslevel=6)
+    logger.info(f"Response compressed: {len(payload)} -> {len(compressed)} bytes")
+    return {
+        "status": response.get("status", "success"),
+        "encoding": "gzip+base64",
+        "data": base64.b64encode(compressed).decode("ascii")
+    }
+# --- end: output compaction ---
+
+# --- begin: result cache ---
+# 内容寻址的结果缓存：文档级（解码后的字节+prompt_type+渲染参数）和页面级（渲染后的像素+prompt_mode）
+CACHE_ENABLED = os.getenv("DOTSOCR_CACHE", "1") == "1"
+CACHE_DIR = os.getenv("DOTSOCR_CACHE_DIR", "/tmp/dotsocr_cache")
+CACHE_MAX_BYTES = int(os.getenv("DOTSOCR_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+_CACHE_LOCK = threading.Lock()
+# 缓存目录当前总字节数，首次写入时扫描得到
+_CACHE_SIZE = None
+
+def _cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _image_digest(image):
+    """Hash of a rendered page's pixels"""
+    digest = hashlib.sha256(f"{image.mode}:{image.size}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def _cache_path(tier, key):
+    return os.path.join(CACHE_DIR, tier, key[:2], f"{key}.json")
+
+def _iter_cache_files():
+    for root, _, files in os.walk(CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield path, stat.st_mtime, stat.st_size
+
+def _cache_get(tier, key):
+    """Return the cached value or None; a hit refreshes the entry's LRU position"""
+    path = _cache_path(tier, key)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            value = json.load(f)
+        # mtime作为LRU时间戳
+        os.utime(path)
+        return value
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+        return None
+
+def _cache_put(tier, key, value):
+    """Store a value and evict least recently used entries when over CACHE_MAX_BYTES"""
+    global _CACHE_SIZE
+    path = _cache_path(tier, key)
+    try:
+        with _stage("cache"):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+            if len(data) > CACHE_MAX_BYTES:
+                return
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            with _CACHE_LOCK:
+                if _CACHE_SIZE is None:
+                    _CACHE_SIZE = sum(size for _, _, size in _iter_cache_files())
+                else:
+                    _CACHE_SIZE += len(data)
+                os.replace(tmp_path, path)
+                if _CACHE_SIZE > CACHE_MAX_BYTES:
+                    _evict_cache()
+    except Exception as e:
+        logger.warning(f"Failed to write cache entry {path}: {e}")
+
+def _evict_cache():
+    """Delete the oldest entries until the cache is back under 90% of its size limit"""
+    global _CACHE_SIZE
+    entries = sorted(_iter_cache_files(), key=lambda entry: entry[1])
+    _CACHE_SIZE = sum(size for _, _, size in entries)
+    target = CACHE_MAX_BYTES * 0.9
+    evicted = 0
+    for path, _, size in entries:
+        if _CACHE_SIZE <= target:
+            break
+        try:
+            os.unlink(path)
+            _CACHE_SIZE -= size
+            evicted += 1
+        except OSError:
+            pass
+    logger.info(f"Result cache evicted {evicted} entries, size now {_CACHE_SIZE} bytes")
+
+def _new_cache_stats(options=None):
+    """Per-job cache state; use_cache=false in the job input bypasses both tiers"""
+    enabled = CACHE_ENABLED and (options or {}).get("use_cache", True) is not False
+    return {"enabled": enabled, "document": "miss" if enabled else "bypass", "page_hits": 0, "page_misses": 0}
+
+def _cache_report(cache_stats):
+    return {key: value for key, value in cache_stats.items() if key != "enabled"}
+
+def _output_settings(options=None):
+    """Job options that change the response content, part of the document cache key"""
+    return {
+        "image_mode": _image_mode(options),
+        "text_layer_mode": _text_layer_mode(options),
+        "page_filter": _page_filter_mode(options),
+        "categories": _region_categories((options or {}).get("prompt_type"), options)
+    }
+
+def _document_cache_key(input_type, input_document, prompt_type, options=None, pages=None):
+    """Cache key of a document response; pages is the page selection of a partial PDF job"""
+    with _stage("cache"):
+        digest = input_document.sha256 or hashlib.sha256(input_document.data).hexdigest()
+        return _cache_key(input_type, digest, prompt_type, _raster_settings(options), _output_settings(options), *([pages] if pages else []))
+
+def _cached_page_result(cached, page_number):
+    """Re-tag a cached page result with the page number it is reused for"""
+    for item in cached["layout_data"]:
+        if isinstance(item, dict):
+            item['page_number'] = page_number
+    cached["page_number"] = page_number
+    return cached
+# --- end: result cache ---
+
+# --- begin: text-layer fast path ---
+# 对于自带完整文本层的PDF页面（简历、生成的报告等），直接使用嵌入文本，跳过渲染和VLM推理
+TEXT_LAYER_MODES = ("off", "auto")
+TEXT_LAYER_MIN_CHARS = int(os.getenv("DOTSOCR_TEXT_LAYER_MIN_CHARS", "50"))
+TEXT_LAYER_MAX_IMAGE_COVERAGE = float(os.getenv("DOTSOCR_TEXT_LAYER_MAX_IMAGE_COVERAGE", "0.2"))
+
+def _text_layer_mode(options=None):
+    return _get_choice_option(options, "text_layer_mode", "DOTSOCR_TEXT_LAYER_MODE", TEXT_LAYER_MODES, "off")
+
+def _inspect_text_layer(page):
+    """Measure a page's text layer and how much of it is covered by images
+
+    Returns (use_text_layer, text_blocks, stats). text_blocks are
+    (x0, y0, x1, y1, text) tuples in PDF points.
+    """
+    page_area = abs(page.rect) or 1.0
+    text_blocks = [
+        (x0, y0, x1, y1, text.strip())
+        for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks")
+        if block_type == 0 and text.strip()
+    ]
+    text_chars = sum(len(block[4]) for block in text_blocks)
+    # 无法映射到Unicode的字符比例过高说明文本层不可用（字体缺少ToUnicode等）
+    bad_chars = sum(block[4].count("\ufffd") for block in text_blocks)
+
+    image_area = 0.0
+    for image_info in page.get_image_info():
+        image_rect = fitz.Rect(image_info["bbox"]) & page.rect
+        if not image_rect.is_empty:
+            image_area += abs(image_rect)
+    image_coverage = min(1.0, image_area / page_area)
+
+    use_text_layer = (
+        text_chars >= TEXT_LAYER_MIN_CHARS
+        and image_coverage <= TEXT_LAYER_MAX_IMAGE_COVERAGE
+        and bad_chars <= 0.1 * text_chars
+    )
+    stats = {"text_chars": text_chars, "image_coverage": round(image_coverage, 3)}
+    return use_text_layer, text_blocks, stats
+
+def _text_layer_page_result(page_number, text_blocks, prompt_mode, zoom_factor=PDF_ZOOM_FACTOR):
+    """Build a page result from embedded text in the same schema as parsed pages
+
+    bboxes are scaled to the pixel space of the page rendered at
+    zoom_factor (see _page_zoom), like the boxes dots.ocr returns for
+    rendered pages.
+    """
+    layout_data = []
+    if prompt_mode != "prompt_ocr":
+        for x0, y0, x1, y1, text in text_blocks:
+            item = {
+                "bbox": [int(round(coord * zoom_factor)) for coord in (x0, y0, x1, y1)],
+                "category": "Text",
+                "page_number": page_number
+            }
+            if prompt_mode != "prompt_layout_only_en":
+                item["text"] = text
+            layout_data.append(item)
+
+    markdown = ""
+    if prompt_mode != "prompt_layout_only_en":
+        markdown = "\n\n".join(block[4] for block in text_blocks)
+
+    return {
+        "page_number": page_number,
+        "markdown": markdown,
+        "layout_data": layout_data,
+        "status": "success"
+    }
+# --- end: text-layer fast path ---
+
+# --- begin: region-targeted parsing ---
+# prompt_type "region_parsing"：先用prompt_layout_only_en检测布局，只裁剪调用方需要的类别区域，
+# 再对这些小图批量做prompt_ocr识别；页面大部分内容无关时解码的token数大幅减少
+REGION_PROMPT_TYPE = "region_parsing"
+# dots.ocr的布局类别
+LAYOUT_CATEGORIES = ("Caption", "Footnote", "Formula", "List-item", "Page-footer", "Page-header", "Picture", "Section-header", "Table", "Text", "Title")
+# 图片区域没有文字可识别，只返回bbox
+_UNRECOGNIZED_CATEGORIES = ("Picture",)
+# 裁剪时在bbox四周多留的像素，避免切掉笔画边缘
+REGION_CROP_PADDING = 4
+# 区域小图比整页小得多，识别时每批可以放更多张（HF后端）
+REGION_BATCH_SIZE = 8
+
+def _new_batch_state(page_batch_size, options=None):
+    """Per-job batch sizes, shrunk on OOM and kept for the rest of the job
+
+    "region" is the batch state of region_parsing's crop pass. It defaults
+    to region_batch_size (env DOTSOCR_REGION_BATCH_SIZE), but never exceeds
+    a page_batch_size the job set explicitly (e.g. 1 to avoid OOM).
+    """
+    region_batch_size = max(1, _get_int_option(options, "region_batch_size", "DOTSOCR_REGION_BATCH_SIZE", REGION_BATCH_SIZE))
+    if (options or {}).get("page_batch_size") is not None or os.getenv("DOTSOCR_PAGE_BATCH_SIZE") is not None:
+        region_batch_size = min(region_batch_size, page_batch_size)
+    return {"size": page_batch_size, "region": {"size": region_batch_size}}
+
+def _region_categories(prompt_type, options=None):
+    """Sorted categories to recognize for region_parsing, or None for the other prompt types
+
+    Taken from the job's categories (a list or comma-separated string),
+    falling back to DOTSOCR_REGION_CATEGORIES.
+    """
+    if prompt_type != REGION_PROMPT_TYPE:
+        return None
+    categories = (options or {}).get("categories") or os.getenv("DOTSOCR_REGION_CATEGORIES", "Table,Text")
+    if isinstance(categories, str):
+        categories = categories.split(",")
+    selected = []
+    for category in categories:
+        category = str(category).strip()
+        if category in LAYOUT_CATEGORIES:
+            selected.append(category)
+        elif category:
+            logger.warning(f"Unknown layout category {category!r} ignored")
+    if not selected:
+        raise ValueError(f"region_parsing needs at least one of these categories: {', '.join(LAYOUT_CATEGORIES)}")
+    return sorted(set(selected))
+
+def _crop_region(image, bbox):
+    if not isinstance(bbox, (list, tuple)) or len(bbox) != 4:
+        return None
+    x0, y0, x1, y1 = (int(round(coord)) for coord in bbox)
+    x0, y0 = max(0, x0 - REGION_CROP_PADDING), max(0, y0 - REGION_CROP_PADDING)
+    x1, y1 = min(image.width, x1 + REGION_CROP_PADDING), min(image.height, y1 + REGION_CROP_PADDING)
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return None
+    return image.crop((x0, y0, x1, y1))
+
+def _regions_markdown(layout_data):
+    """Markdown for selected regions in reading order, with titles and section headers as headings"""
+    parts = []
+    for item in layout_data:
+        text = item.get("text")
+        if not text:
+            continue
+        if item.get("category") == "Title":
+            text = f"# {text}"
+        elif item.get("category") == "Section-header":
+            text = f"## {text}"
+        parts.append(text)
+    return "\n\n".join(parts)
+
+def _parse_regions(parser, pages, categories, batch_state, image_mode="keep"):
+    """Two-pass parsing of (page_number, image) pairs, returning one page result per page
+
+    Pass one detects the layout of every page; pass two recognizes the crops
+    of the regions whose category is in categories, for all pages in one
+    batch (sized by batch_state["region"], see _new_batch_state). Only the
+    selected regions are returned, in reading order.
+    page_number None (image input) leaves the layout items untagged.
+    """
+    with _stage("inference"):
+        layout_results = _infer_images(
+            parser,
+            [img for _, img in pages],
+            "prompt_layout_only_en",
+            [f"page_{page_number or 1}_layout" for page_number, _ in pages],
+            batch_state
+        )
+
+    page_regions = []
+    crops = []
+    for position, ((page_number, img), raw_result) in enumerate(zip(pages, layout_results)):
+        if isinstance(raw_result, Exception):
+            page_regions.append(raw_result)
+            continue
+        with _stage("result_read"):
+            _, layout_data = extract_content_from_result(raw_result, page_number)
+        selected = [item for item in layout_data if isinstance(item, dict) and item.get("category") in categories]
+        logger.info(f"Page {page_number or 1} - {len(selected)} of {len(layout_data)} layout regions selected")
+        page_regions.append(selected)
+        for item in selected:
+            if page_number is None:
+                item.pop("page_number", None)
+            crop = None if item["category"] in _UNRECOGNIZED_CATEGORIES else _crop_region(img, item.get("bbox"))
+            if crop is not None:
+                crops.append((position, item, crop))
+
+    image_tables = [{} for _ in pages]
+    if crops:
+        logger.info(f"Recognizing {len(crops)} regions with DotsOCR...")
+        with _stage("inference"):
+            region_results = _infer_images(
+                parser,
+                [crop for _, _, crop in crops],
+                "prompt_ocr",
+                [f"page_{pages[position][0] or 1}_region_{i}" for i, (position, _, _) in enumerate(crops)],
+                batch_state["region"]
+            )
+        for (position, item, _), raw_result in zip(crops, region_results):
+            if isinstance(raw_result, Exception):
+                item["region_error"] = str(raw_result)
+                continue
+            with _stage("result_read"):
+                text, _ = extract_content_from_result(raw_result, pages[position][0], image_mode, image_tables[position])
+            item["text"] = text.strip()
+
+    page_results = []
+    for position, (page_number, _) in enumerate(pages):
+        regions = page_regions[position]
+        if isinstance(regions, Exception):
+            page_results.append(_page_result(page_number, regions, image_mode))
+            continue
+        page_result = {
+            "page_number": page_number,
+            "markdown": _regions_markdown(regions),
+            "layout_data": regions,
+            "status": "success"
+        }
+        if image_mode == "reference":
+            page_result["images"] = image_tables[position]
+        page_results.append(page_result)
+    return page_results
+# --- end: region-targeted parsing ---
+
+# --- begin: blank and duplicate page detection ---
+# 扫描件里常见空白分隔页和重复页（相同的封面、条款页）；渲染后、推理前判断，
+# 空白页直接跳过，与之前某页像素完全相同的页面复用该页的结果。
+# 只识别逐像素相同的重复页（同一页在文档里再次出现）：缩略图级的相似度分辨不出
+# 只有几个字段不同的表单，重新扫描的同一页也不会被当成重复页
+PAGE_FILTER_MODES = ("off", "auto")
+PAGE_FILTER_THUMB = 256
+# 比纸张背景暗这么多灰度级的像素算作墨迹
+PAGE_FILTER_INK_DELTA = 64
+BLANK_MAX_INK = float(os.getenv("DOTSOCR_BLANK_MAX_INK", "0.001"))
+# 为重复页保留的已完成页面结果数上限，保证大文档内存有界
+DUPLICATE_WINDOW = int(os.getenv("DOTSOCR_DUPLICATE_WINDOW", "64"))
+
+def _page_filter_mode(options=None):
+    return _get_choice_option(options, "page_filter", "DOTSOCR_PAGE_FILTER", PAGE_FILTER_MODES, "off")
+
+def _new_page_filter(options=None):
+    """Per-job blank/duplicate detection state, or None when page_filter is off
+
+    "seen" maps the pixel digest (see _image_digest) of recently parsed
+    pages to (page_number, page_result).
+    """
+    if _page_filter_mode(options) != "auto":
+        return None
+    return {"seen": collections.OrderedDict()}
+
+def _ink_coverage(img):
+    """Fraction of a downscaled page's pixels clearly darker than its paper background"""
+    scale = PAGE_FILTER_THUMB / max(img.size)
+    thumb_size = (max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale)))
+    thumb = img.resize(thumb_size, Image.BOX, reducing_gap=2.0).convert("L")
+
+    histogram = thumb.histogram()
+    total = sum(histogram)
+    # 纸张背景取90%分位的亮度，扫描件的灰底/泛黄也能适应
+    cumulative = 0
+    background = 255
+    for level, count in enumerate(histogram):
+        cumulative += count
+        if cumulative >= total * 0.9:
+            background = level
+            break
+    ink_pixels = sum(histogram[:max(0, background - PAGE_FILTER_INK_DELTA)])
+    return ink_pixels / total
+
+def _find_duplicate(page_filter, digest):
+    """(page_number, page_result) of an earlier, successfully parsed page with the same pixels, or None"""
+    return page_filter["seen"].get(digest)
+
+def _remember_page(page_filter, page_number, digest, page_result):
+    page_filter["seen"][digest] = (page_number, page_result)
+    page_filter["seen"].move_to_end(digest)
+    while len(page_filter["seen"]) > DUPLICATE_WINDOW:
+        page_filter["seen"].popitem(last=False)
+
+def _blank_page_result(page_number, ink_coverage):
+    return {
+        "page_number": page_number,
+        "markdown": "",
+        "layout_data": [],
+        "status": "success",
+        "page_filter": "blank",
+        "ink_coverage": round(ink_coverage, 5)
+    }
+
+def _duplicate_page_result(page_result, page_number, duplicate_of):
+    """Copy of an earlier page's result, re-tagged for page_number"""
+    page_result = _cached_page_result(copy.deepcopy(page_result), page_number)
+    page_result.update({"page_filter": "duplicate", "duplicate_of": duplicate_of})
+    return page_result
+# --- end: blank and duplicate page detection ---
+
+def _page_result(page_number, raw_result, image_mode="keep"):
+    """Turn a parser result (or the exception raised for the page) into a page result dict"""
+    if isinstance(raw_result, Exception):
+        logger.error(f"Error processing page {page_number}: {str(raw_result)}")
+        # 继续处理下一页，但记录错误
+        return {
+            "page_number": page_number,
+            "markdown": "",
+            "layout_data": [],
+            "status": "error",
+            "page_error": str(raw_result)
+        }
+
+    # 处理当前页面的结果
+    image_table = {}
+    with _stage("result_read"):
+        page_markdown, page_layout = extract_content_from_result(raw_result, page_number, image_mode, image_table)
+    logger.info(f"Page {page_number} processed successfully")
+    page_result = {
+        "page_number": page_number,
+        "markdown": page_markdown,
+        "layout_data": page_layout,
+        "status": "success"
+    }
+    if image_mode == "reference":
+        page_result["images"] = image_table
+    return page_result
+
+def _parse_page_batch(parser, batch, prompt_mode, total_pages, batch_state, cache_stats=None, image_mode="keep", page_filter=None, region_categories=None):
+    """Parse a group of rendered pages, yielding page results in page order
+
+    With a page_filter state (see _new_page_filter), blank pages are skipped
+    and pages pixel-identical to an earlier parsed page reuse its result;
+    repeats within the batch are parsed once. With region_categories, pages
+    are parsed in two passes by _parse_regions.
+    """
+    raw_results = {}
+    region_results = {}
+    cached_results = {}
+    page_keys = {}
+    digests = {}
+    pending = []
+    # 本batch内的重复页：digest -> 第一次出现的页面，page_index -> 复用的页面
+    batch_digests = {}
+    repeats = {}
+    for page_index, img, render_error in batch:
+        logger.info(f"Processing page {page_index + 1}/{total_pages}")
+        if render_error:
+            raw_results[page_index] = RuntimeError(f"Failed to render page: {render_error}")
+            continue
+        if page_filter is not None:
+            with _stage("page_filter"):
+                ink_coverage = _ink_coverage(img)
+                is_blank = ink_coverage <= BLANK_MAX_INK
+                if not is_blank:
+                    digests[page_index] = _image_digest(img)
+                    duplicate = _find_duplicate(page_filter, digests[page_index])
+            if is_blank:
+                logger.info(f"Page {page_index + 1} - blank (ink coverage {ink_coverage:.5f}), skipped")
+                cached_results[page_index] = _blank_page_result(page_index + 1, ink_coverage)
+                continue
+            if duplicate is not None:
+                logger.info(f"Page {page_index + 1} - duplicate of page {duplicate[0]}, reusing its result")
+                cached_results[page_index] = _duplicate_page_result(duplicate[1], page_index + 1, duplicate[0])
+                continue
+            if digests[page_index] in batch_digests:
+                repeats[page_index] = batch_digests[digests[page_index]]
+                logger.info(f"Page {page_index + 1} - duplicate of page {repeats[page_index] + 1} in the same batch, parsed once")
+                continue
+        if cache_stats and cache_stats["enabled"]:
+            with _stage("cache"):
+                digest = digests[page_index] if page_index in digests else _image_digest(img)
+                page_keys[page_index] = _cache_key("page", digest, prompt_mode, image_mode, *([region_categories] if region_categories else []))
+                cached = _cache_get("pages", page_keys[page_index])
+            if cached is not None:
+                logger.info(f"Page {page_index + 1} - result cache hit")
+                cache_stats["page_hits"] += 1
+                cached_results[page_index] = _cached_page_result(cached, page_index + 1)
+                if page_index in digests:
+                    _remember_page(page_filter, page_index + 1, digests[page_index], cached_results[page_index])
+                continue
+            cache_stats["page_misses"] += 1
+        if page_index in digests:
+            batch_digests[digests[page_index]] = page_index
+        pending.append((page_index, img))
+
+    if pending:
+        # 使用DotsOCR处理页面图像
+        logger.info(f"Processing pages {[i + 1 for i, _ in pending]} with DotsOCR...")
+        if region_categories is not None:
+            region_page_results = _parse_regions(parser, [(i + 1, img) for i, img in pending], region_categories, batch_state, image_mode)
+            region_results.update(zip([i for i, _ in pending], region_page_results))
+        else:
+            with _stage("inference"):
+                batch_results = _infer_images(
+                    parser,
+                    [img for _, img in pending],
+                    prompt_mode,
+                    [f"page_{i + 1}" for i, _ in pending],
+                    batch_state
+                )
+            raw_results.update(zip([i for i, _ in pending], batch_results))
+
+    parsed = {}
+    for page_index, img, _ in batch:
+        if page_index in cached_results:
+            page_result = cached_results[page_index]
+        elif page_index in repeats:
+            original = parsed[repeats[page_index]]
+            if original["status"] == "success":
+                page_result = _duplicate_page_result(original, page_index + 1, repeats[page_index] + 1)
+            else:
+                page_result = {**original, "page_number": page_index + 1}
+        else:
+            if page_index in region_results:
+                page_result = region_results[page_index]
+            else:
+                page_result = _page_result(page_index + 1, raw_results[page_index], image_mode)
+            if page_index in page_keys and page_result["status"] == "success":
+                _cache_put("pages", page_keys[page_index], page_result)
+            if page_index in digests and page_result["status"] == "success":
+                _remember_page(page_filter, page_index + 1, digests[page_index], page_result)
+            parsed[page_index] = page_result
+        if img is not None and "raster" in img.info:
+            # 渲染参数（缓存和重复页之外单独附加，始终是本次渲染的值）
+            page_result = {**page_result, "raster": img.info["raster"]}
+        yield page_result
+
+# --- begin: deadline-aware page planning ---
+# page_range / max_pages选择要处理的页面，page_order决定处理顺序；time_budget_s给出本任务的时间预算。
+# 每个batch开始前用每页耗时估计判断剩余时间是否够用，不够时停止，返回已完成的页面和
+# remaining_pages，调用方可以把remaining_pages作为下一个任务的page_range继续处理
+PAGE_ORDERS = ("document", "listed", "reverse")
+# 为合并结果、序列化和上传预留的时间
+DEADLINE_RESERVE_S = float(os.getenv("DOTSOCR_DEADLINE_RESERVE_S", "3"))
+# 没有历史数据时（冷启动后的第一个任务）的每页耗时估计
+PAGE_COST_DEFAULT_S = float(os.getenv("DOTSOCR_PAGE_COST_S", "5"))
+
+def _page_order(options=None):
+    return _get_choice_option(options, "page_order", "DOTSOCR_PAGE_ORDER", PAGE_ORDERS, "document")
+
+def _parse_page_range(page_range, total_pages):
+    """0-based page indices for a 1-based page_range, in the listed order
+
+    page_range is a string like "1-3,7,10-" (open ends run to the first /
+    last page) or a list of page numbers and such strings. Pages past the
+    end of the document are dropped; repeated pages are kept once.
+    """
+    parts = page_range if isinstance(page_range, list) else [page_range]
+    page_indices = []
+    seen = set()
+    for part in parts:
+        for item in (part.split(",") if isinstance(part, str) else [part]):
+            try:
+                if isinstance(item, int):
+                    first = last = item
+                else:
+                    first, dash, last = item.strip().partition("-")
+                    first = int(first) if first.strip() or not dash else 1
+                    last = (int(last) if last.strip() else total_pages) if dash else first
+            except (AttributeError, TypeError, ValueError):
+                raise ValueError(f"Invalid page_range item {item!r}")
+            if first < 1 or last < first:
+                raise ValueError(f"Invalid page_range item {item!r}")
+            for page_index in range(first - 1, min(last, total_pages)):
+                if page_index not in seen:
+                    seen.add(page_index)
+                    page_indices.append(page_index)
+    if not page_indices:
+        raise ValueError(f"page_range {page_range!r} selects no pages of this {total_pages} page PDF")
+    return page_indices
+
+def _page_plan(total_pages, options=None):
+    """Per-job page plan: which pages to parse in which order, and the deadline
+
+    The plan is filled in by _iter_pdf_pages (remaining pages, stop reason,
+    measured page cost) and reported by _plan_report.
+    """
+    options = options or {}
+    page_range = options.get("page_range")
+    order = _parse_page_range(page_range, total_pages) if page_range not in (None, "", []) else list(range(total_pages))
+    page_order = _page_order(options)
+    if page_order == "document":
+        order.sort()
+    elif page_order == "reverse":
+        order.sort(reverse=True)
+
+    max_pages = _get_int_option(options, "max_pages", "DOTSOCR_MAX_PAGES", 0)
+    deferred = []
+    if 0 < max_pages < len(order):
+        order, deferred = order[:max_pages], order[max_pages:]
+
+    time_budget_s = _get_float_option(options, "time_budget_s", "DOTSOCR_TIME_BUDGET_S", 0.0)
+    return {
+        "order": order,
+        "deferred": deferred,
+        # 选择了部分页面时，结果缓存的键包含所选页面
+        "pages": sorted(order) if len(order) < total_pages else None,
+        "time_budget_s": time_budget_s if time_budget_s > 0 else None,
+        "deadline": _job_start() + time_budget_s if time_budget_s > 0 else None,
+        "remaining": [],
+        "stop_reason": None,
+        "pages_done": 0,
+        "cost_s": 0.0
+    }
+
+def _page_cost_estimate(plan):
+    """Expected seconds per page: this job's own pages once measured, else recent history"""
+    if plan["pages_done"]:
+        return plan["cost_s"] / plan["pages_done"]
+    return _stage_percentile("page", 0.9) or PAGE_COST_DEFAULT_S
+
+def _deadline_batch_size(plan, size):
+    """How many of the next size pages fit in the time left before the deadline"""
+    if plan["deadline"] is None:
+        return size
+    available = plan["deadline"] - DEADLINE_RESERVE_S - time.perf_counter()
+    return max(0, min(size, int(available // _page_cost_estimate(plan))))
+
+def _record_page_cost(plan, pages, seconds):
+    plan["pages_done"] += pages
+    plan["cost_s"] += seconds
+    for _ in range(pages):
+        _add_stage_history("page", seconds / pages)
+
+def _plan_report(plan):
+    """Response fields for a job that left pages unprocessed (for a follow-up job's page_range)"""
+    report = {}
+    remaining = plan["remaining"] + plan["deferred"]
+    if remaining:
+        report["partial"] = True
+        report["stop_reason"] = plan["stop_reason"] or "max_pages"
+        report["remaining_pages"] = [page_index + 1 for page_index in remaining]
+    if plan["time_budget_s"] is not None:
+        report["time_budget_s"] = plan["time_budget_s"]
+        report["page_cost_s"] = round(_page_cost_estimate(plan), 3)
+    return report
+# --- end: deadline-aware page planning ---
+
+def _iter_pdf_pages(parser, pdf_document, input_document, prompt_type, options=None, cache_stats=None, plan=None):
+    """Parse PDF pages, yielding each page result as soon as it is ready
+
+    Each item is a dict with page_number, markdown, layout_data and status;
+    failed pages carry status "error" and a page_error message instead.
+    With page_batch_size > 1 on the HF backend, pages are parsed in groups
+    and the results of a group are yielded together. With text_layer_mode
+    "auto", born-digital pages are answered from their text layer and only
+    the remaining pages are rendered and parsed; each page then carries its
+    source ("text_layer" or "ocr"). With page_filter "auto", blank pages
+    are skipped and pixel-identical repeated pages reuse the earlier
+    result; those pages carry page_filter ("blank" or "duplicate").
+    Rendered pages carry their raster report (zoom, dpi, pixels,
+    colorspace; see _render_page).
+
+    Pages are parsed in the order of the page plan (see _page_plan); when
+    the next pages would not finish before its deadline, parsing stops and
+    the unparsed pages are recorded in plan["remaining"].
+    """
+    total_pages = len(pdf_document)
+    plan = plan if plan is not None else _page_plan(total_pages, options)
+    prompt_mode = _prompt_mode_for(prompt_type)
+    render_workers = _get_int_option(options, "render_workers", "DOTSOCR_RENDER_WORKERS", 2)
+    prefetch_pages = _get_int_option(options, "prefetch_pages", "DOTSOCR_PREFETCH_PAGES", 4)
+    page_batch_size = max(1, _get_int_option(options, "page_batch_size", "DOTSOCR_PAGE_BATCH_SIZE", 1))
+
+    if _SCHEDULER is not None:
+        # 一次提交多页，调度器才能把它们和其他任务的页面合并
+        page_batch_size = max(page_batch_size, _SCHEDULER.max_batch_size)
+    elif INFERENCE_BACKEND == "openai":
+        # 推理服务端做continuous batching：同一文档的多页同时发出
+        page_batch_size = max(page_batch_size, OPENAI_CONCURRENCY)
+    elif page_batch_size > 1 and not _supports_hf_batching(parser):
+        logger.warning("Batched page inference needs the HF backend (use_hf=True), falling back to batch size 1")
+        page_batch_size = 1
+    # OOM时会被缩小，并在本次任务的后续batch中沿用
+    batch_state = _new_batch_state(page_batch_size, options)
+    image_mode = _image_mode(options)
+    page_filter = _new_page_filter(options)
+    region_categories = _region_categories(prompt_type, options)
+    raster_settings = _raster_settings(options)
+
+    # 按计划顺序逐页处理：混合模式下轮到该页时才检查文本层，文本层页面立即输出，
+    # 只有扫描页/图片为主的页面才渲染并送入模型。最多提前检查lookahead个OCR页面：
+    # 当前batch之外再留prefetch_pages页供预渲染；暂存的结果也有上限，所以内存占用与页数无关
+    order = plan["order"]
+    text_layer_auto = _text_layer_mode(options) == "auto"
+    if text_layer_auto and region_categories is not None and region_categories != ["Text"]:
+        # 文本层只能给出Text块：需要表格、标题等其他类别时每页都走两阶段OCR
+        logger.info(f"region_parsing categories {region_categories} need layout detection, not using the text layer")
+        text_layer_auto = False
+    lookahead = page_batch_size + max(prefetch_pages, 1)
+    queue = collections.deque()      # 已检查、尚未输出的页面（计划顺序）
+    results = {}                     # queue中已有结果的页面
+    ocr_stats = {}
+    to_render = collections.deque()  # 渲染迭代器从这里按需取页
+    ocr_queued = 0                   # queue中等待进入batch的OCR页面数
+    position = 0                     # order中下一个要检查的页面
+    # 是否使用渲染进程池只看计划里的页数：to_render是逐步填充的，开始时的长度说明不了什么
+    rendered_pages = _iter_rendered_pages(pdf_document, input_document, to_render, render_workers if len(order) > 1 else 0, prefetch_pages, raster_settings)
+    try:
+        while True:
+            while position < len(order) and ocr_queued < lookahead and len(queue) < 2 * lookahead:
+                page_index = order[position]
+                position += 1
+                queue.append(page_index)
+                page_result, stats = None, None
+                if text_layer_auto:
+                    page_result, stats = _text_layer_page(pdf_document, page_index, prompt_mode, raster_settings)
+                if page_result is not None:
+                    results[page_index] = page_result
+                else:
+                    if stats is not None:
+                        ocr_stats[page_index] = stats
+                    to_render.append(page_index)
+                    ocr_queued += 1
+
+            while queue and queue[0] in results:
+                yield results.pop(queue.popleft())
+            if not queue:
+                if position >= len(order):
+                    break
+                continue
+
+            # 队首是OCR页面：解析下一个batch
+            size = _deadline_batch_size(plan, min(batch_state["size"], ocr_queued))
+            if size == 0:
+                # 时间预算不够再处理一页：干净地停止，剩余页面留给后续任务；已得到的文本层页面照常输出
+                plan["remaining"] = [page_index for page_index in queue if page_index not in results] + order[position:]
+                plan["stop_reason"] = "time_budget"
+                logger.warning(f"Time budget nearly used up, stopping with {len(plan['remaining'])} pages left "
+                               f"(estimated {_page_cost_estimate(plan):.2f}s per page)")
+                for page_index in queue:
+                    if page_index in results:
+                        yield results.pop(page_index)
+                break
+            batch_start = time.perf_counter()
+            batch = list(itertools.islice(rendered_pages, size))
+            if not batch:
+                break
+            ocr_queued -= len(batch)
+            for page_result in _parse_page_batch(parser, batch, prompt_mode, total_pages, batch_state, cache_stats, image_mode, page_filter, region_categories):
+                page_index = page_result["page_number"] - 1
+                if page_index in ocr_stats:
+                    page_result.update({"source": "ocr", **ocr_stats.pop(page_index)})
+                results[page_index] = page_result
+            _record_page_cost(plan, len(batch), time.perf_counter() - batch_start)
+    finally:
+        # 停止时取消已提交的预渲染
+        rendered_pages.close()
+
+def _text_layer_page(pdf_document, page_index, prompt_mode, raster_settings):
+    """Inspect one page's text layer: (page_result, stats), page_result None when the page needs OCR"""
+    try:
+        with _stage("text_layer"):
+            page = pdf_document.load_page(page_index)
+            use_text_layer, text_blocks, stats = _inspect_text_layer(page)
+    except Exception as e:
+        logger.warning(f"Page {page_index + 1} - text layer inspection failed: {e}")
+        return None, {}
+    if not use_text_layer:
+        return None, stats
+    logger.info(f"Page {page_index + 1} - answered from text layer {stats}")
+    page_result = _text_layer_page_result(page_index + 1, text_blocks, prompt_mode, _page_zoom(page.rect, raster_settings))
+    page_result.update({"source": "text_layer", **stats})
+    return page_result, stats
+
+def _build_pdf_response(page_results, total_pages):
+    """Merge per-page results into the aggregated PDF response, in page order"""
+    page_results = sorted(page_results, key=lambda page_result: page_result["page_number"])
+    all_markdown_content = []
+    all_layout_data = []
+    image_table = None
+    page_sources = []
+    filtered_pages = []
+    page_rasters = []
+
+    for page_result in page_results:
+        page_number = page_result["page_number"]
+        if "raster" in page_result:
+            # 每页实际使用的缩放、有效DPI、像素数和色彩空间
+            page_rasters.append({"page_number": page_number, **page_result["raster"]})
+        if "page_filter" in page_result:
+            # 未经推理的页面：空白页被跳过，重复页复用了之前页面的结果
+            filtered_pages.append({
+                "page_number": page_number,
+                "reason": page_result["page_filter"],
+                "duplicate_of": page_result.get("duplicate_of")
+            })
+        if "source" in page_result:
+            # 混合模式下每页的处理方式（文本层 / OCR）
+            page_sources.append({
+                "page_number": page_number,
+                "source": page_result["source"],
+                "text_chars": page_result.get("text_chars"),
+                "image_coverage": page_result.get("image_coverage")
+            })
+        if page_result["status"] == "error":
+            error_content = f"\n\n## Page {page_number} - Processing Error\n\nError: {page_result['page_error']}\n\n"
+            all_markdown_content.append(error_content)
+            continue
+
+        # 添加页面标题
+        page_header = f"\n\n## Page {page_number}\n\n"
+        all_markdown_content.append(page_header + page_result["markdown"])
+        all_layout_data.extend(page_result["layout_data"])
+        if "images" in page_result:
+            # 跨页去重后的图片表
+            image_table = image_table if image_table is not None else {}
+            image_table.update(page_result["images"])
+
+    # 合并所有页面的内容
+    combined_markdown = "".join(all_markdown_content)
+    combined_layout = all_layout_data
+
+    logger.info(f"PDF processing completed. Total pages: {total_pages}")
+    logger.info(f"Final markdown length: {len(combined_markdown)}")
+    logger.info(f"Final layout data items: {len(combined_layout)}")
+
+    response = {
+        "markdown": combined_markdown,
+        "layout_data": combined_layout,
+        "status": "success",
+        "input_type": "pdf",
+        "total_pages": total_pages,
+        "pages_processed": len([c for c in all_markdown_content if "Page" in c and "Error" not in c])
+    }
+    if image_table is not None:
+        response["images"] = image_table
+    if page_sources:
+        response["page_sources"] = page_sources
+    if filtered_pages:
+        response["filtered_pages"] = filtered_pages
+    if page_rasters:
+        response["page_rasters"] = page_rasters
+    return response
+
+# --- begin: result spooling ---
+# output_mode "spool"：逐页把结果写入JSONL spool文件，上传到结果存储后只返回清单（manifest），
+# 不再在内存里拼接整份markdown/layout_data，几百页的文档内存占用也保持不变
+OUTPUT_MODES = ("inline", "spool")
+# 结果存储：本地目录（可以是挂载的网络卷）；DOTSOCR_RESULT_BASE_URL把文件名映射为对外URL
+RESULT_STORE_DIR = os.getenv("DOTSOCR_RESULT_STORE", "/tmp/dotsocr_results")
+RESULT_BASE_URL = os.getenv("DOTSOCR_RESULT_BASE_URL")
+
+def _output_mode(options=None):
+    return _get_choice_option(options, "output_mode", "DOTSOCR_OUTPUT_MODE", OUTPUT_MODES, "inline")
+
+class _ResultSpool:
+    """JSONL spool of page results; keeps only per-page offsets and counts in memory
+
+    Use as a context manager: the local spool file is always removed on
+    exit, after publish() has moved or uploaded it to the result store.
+    """
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="dotsocr_result_", suffix=".jsonl", dir=SPOOL_DIR)
+        self._file = os.fdopen(fd, "wb")
+        self._digest = hashlib.sha256()
+        self.size = 0
+        self.pages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self._file.closed:
+            self._file.close()
+        _remove_spool(self.path)
+        return False
+
+    def add(self, page_result):
+        with _stage("spool_write"):
+            line = (json.dumps(page_result, ensure_ascii=False) + "\n").encode("utf-8")
+            self._file.write(line)
+            self._digest.update(line)
+        entry = {
+            "page_number": page_result["page_number"],
+            "status": page_result["status"],
+            "offset": self.size,
+            "length": len(line),
+            "markdown_chars": len(page_result.get("markdown") or ""),
+            "layout_items": len(page_result.get("layout_data") or [])
+        }
+        if page_result["status"] == "error":
+            entry["page_error"] = page_result.get("page_error")
+        if "source" in page_result:
+            entry["source"] = page_result["source"]
+        if "page_filter" in page_result:
+            entry["page_filter"] = page_result["page_filter"]
+            entry["duplicate_of"] = page_result.get("duplicate_of")
+        if "raster" in page_result:
+            entry["raster"] = page_result["raster"]
+        self.pages.append(entry)
+        self.size += len(line)
+
+    def publish(self, total_pages, options=None):
+        """Upload the spool to the result store and return the manifest response"""
+        self._file.close()
+        upload_url = (options or {}).get("result_upload_url")
+        with _stage("upload"):
+            if upload_url:
+                url = _put_result(self.path, upload_url)
+            else:
+                url = _store_result(self.path, f"{uuid.uuid4().hex}.jsonl")
+
+        succeeded = sum(1 for entry in self.pages if entry["status"] == "success")
+        logger.info(f"PDF results spooled: {len(self.pages)} pages, {self.size} bytes -> {url.split('?', 1)[0]}")
         return {
-            "markdown": combined_markdown,
-            "layout_data": combined_layout,
             "status": "success",
             "input_type": "pdf",
+            "output_mode": "spool",
             "total_pages": total_pages,
-            "pages_processed": len([c for c in all_markdown_content if "Page" in c and "Error" not in c])
+            "pages_processed": succeeded,
+            "result": {
+                "url": url,
+                "format": "jsonl",
+                "bytes": self.size,
+                "sha256": self._digest.hexdigest()
+            },
+            "pages": self.pages,
+            "summary": {
+                "pages_succeeded": succeeded,
+                "pages_failed": len(self.pages) - succeeded,
+                "markdown_chars": sum(entry["markdown_chars"] for entry in self.pages),
+                "layout_items": sum(entry["layout_items"] for entry in self.pages)
+            }
         }
-                
+
+def _store_result(path, name):
+    """Move a finished spool into RESULT_STORE_DIR, returning its URL"""
+    os.makedirs(RESULT_STORE_DIR, exist_ok=True)
+    target = os.path.join(RESULT_STORE_DIR, name)
+    shutil.move(path, target)
+    if RESULT_BASE_URL:
+        return f"{RESULT_BASE_URL.rstrip('/')}/{name}"
+    return f"file://{os.path.abspath(target)}"
+
+def _put_result(path, upload_url):
+    """Stream a finished spool to a caller-provided (e.g. S3 presigned) PUT URL
+
+    The body is re-read from disk on each attempt, so retries never hold
+    the results in memory. Returns the URL without its signing query string.
+    """
+    import requests
+    session = _get_http_session()
+    size = os.path.getsize(path)
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            with open(path, "rb") as f:
+                response = session.put(
+                    upload_url, data=f, timeout=(10, DOWNLOAD_TIMEOUT),
+                    headers={"Content-Length": str(size), "Content-Type": "application/x-ndjson"}
+                )
+            if response.status_code < 500 and response.status_code != 429:
+                response.raise_for_status()
+                return upload_url.split("?", 1)[0]
+            error = f"HTTP {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = str(e)
+        if attempt == DOWNLOAD_RETRIES:
+            raise RuntimeError(f"Result upload failed: {error}")
+        logger.warning(f"Result upload failed ({error}), retrying ({attempt + 1}/{DOWNLOAD_RETRIES})")
+        time.sleep(0.5 * 2 ** attempt)
+# --- end: result spooling ---
+
+def _pdf_job_events(parser, pdf_base64, prompt_type, options=None):
+    """Run a PDF job, yielding a page event per parsed page and then the response
+
+    Page events are {"type": "page", "total_pages": N, **page_result}; the
+    last item is the (not yet finalized) job response. Shared by
+    process_pdf_with_dotsocr and stream_handler: opens the PDF, plans the
+    pages, answers from the document cache (no page events) or parses the
+    pages, spooling them with output_mode "spool", then merges and caches
+    the response.
+    """
+    # 使用PyMuPDF打开PDF文档
+    input_document, pdf_document = _open_pdf(pdf_base64, (options or {}).get('pdf_url'))
+    try:
+        total_pages = len(pdf_document)
+
+        if total_pages == 0:
+            yield {"error": "PDF document has no pages"}
+            return
+
+        plan = _page_plan(total_pages, options)
+        cache_stats = _new_cache_stats(options)
+        if _output_mode(options) == "spool":
+            # 清单指向的结果文件不进入文档缓存，只复用页面缓存
+            cache_stats["document"] = "bypass"
+            with _ResultSpool() as result_spool:
+                for page_result in _iter_pdf_pages(parser, pdf_document, input_document, prompt_type, options, cache_stats, plan):
+                    result_spool.add(page_result)
+                    yield {"type": "page", "total_pages": total_pages, **page_result}
+                response = {**result_spool.publish(total_pages, options), **_plan_report(plan), "cache": _cache_report(cache_stats)}
+            yield response
+            return
+
+        document_key = _document_cache_key("pdf", input_document, prompt_type, options, plan["pages"])
+        if cache_stats["enabled"]:
+            cached = _cache_get("documents", document_key)
+            if cached is not None:
+                logger.info("PDF result cache hit")
+                cache_stats["document"] = "hit"
+                # 计划字段（剩余页面、时间预算）属于本次任务，缓存里不保存
+                yield {**cached, **_plan_report(plan), "cache": _cache_report(cache_stats)}
+                return
+
+        # 逐页处理PDF
+        page_results = []
+        for page_result in _iter_pdf_pages(parser, pdf_document, input_document, prompt_type, options, cache_stats, plan):
+            page_results.append(page_result)
+            yield {"type": "page", "total_pages": total_pages, **page_result}
+    finally:
+        # 关闭PDF文档并删除spool文件
+        _close_pdf(input_document, pdf_document)
+
+    with _stage("merge"):
+        response = _build_pdf_response(page_results, total_pages)
+    # 因时间预算停止的部分结果不缓存
+    if cache_stats["enabled"] and plan["stop_reason"] is None and all(page_result["status"] == "success" for page_result in page_results):
+        _cache_put("documents", document_key, response)
+    response.update(_plan_report(plan))
+    response["cache"] = _cache_report(cache_stats)
+    yield response
+
+def process_pdf_with_dotsocr(parser, pdf_base64, prompt_type, options=None):
+    """Process PDF with DotsOCR and return markdown and layout data with multi-page support"""
+    try:
+        response = None
+        for item in _pdf_job_events(parser, pdf_base64, prompt_type, options):
+            if item.get("type") != "page":
+                response = item
+        return response
+
     except Exception as e:
         logger.error(f"Error processing PDF: {str(e)}")
         return {"error": f"PDF processing failed: {str(e)}"}
 
-def extract_content_from_result(result, page_number):
-    """Extract markdown content and layout data from DotsOCR result"""
+def stream_handler(event):
+    """
+    Generator variant of handler for RunPod streaming (/stream).
+
+    For PDF jobs with "stream": true in the input, every page is yielded as
+    soon as its parse_file call returns:
+        {"type": "page", "page_number": 1, "total_pages": 3,
+         "markdown": "...", "layout_data": [...], "status": "success"}
+    Failed pages have status "error" and a page_error message, so they do
+    not abort the stream. The last item is the same response that handler
+    returns.
+
+    All other jobs (no "stream": true, image inputs, validation errors)
+    yield the handler response once. With return_aggregate_stream, /run and
+    /runsync return the list of yielded items: [response] for those jobs,
+    [page, ..., page, response] for streamed PDF jobs, where the final
+    response repeats the pages' content.
+    """
+    input_data = event['input']
+    prompt_type = input_data.get('prompt_type', 'layout_parsing')
+
+    # 只有调用方显式要求时才逐页输出，否则聚合输出里每页内容会重复一遍
+    if input_data.get("stream") is not True or _input_keys(input_data) not in (["pdf_base64"], ["pdf_url"]):
+        yield handler(event)
+        return
+
+    try:
+        logger.info("Worker Start - DotsOCR Stream Handler")
+        _begin_job_metrics(input_data)
+        try:
+            parser = _get_parser()
+        except ImportError:
+            # 交给handler生成mock响应
+            yield handler(event)
+            return
+
+        with _job_workspace():
+            for item in _pdf_job_events(parser, input_data.get('pdf_base64'), prompt_type, input_data):
+                if item.get("type") == "page":
+                    yield item
+                else:
+                    yield _finalize_response(item, input_data)
+
+    except Exception as e:
+        logger.error(f"Error in stream handler: {str(e)}")
+        yield {"error": f"PDF processing failed: {str(e)}"}
+
+def extract_content_from_result(result, page_number, image_mode="keep", image_table=None):
+    """Extract markdown content and layout data from DotsOCR result
+
+    image_mode controls embedded base64 images in the markdown: "keep" leaves
+    them inline, "strip" removes them and "reference" moves them into
+    image_table (see _compact_markdown).
+    """
     markdown_content = ""
     layout_data = []
     
@@ -265,41 +2737,21 @@ def extract_content_from_result(result, page_number):
             first_result = result[0]
             
             if isinstance(first_result, dict):
-                # 检查是否有markdown文件路径
-                if 'md_content_path' in first_result:
-                    md_file_path = first_result['md_content_path']
-                    logger.info(f"Page {page_number} - Found markdown file path: {md_file_path}")
-                    
-                    try:
-                        if os.path.exists(md_file_path):
-                            with open(md_file_path, 'r', encoding='utf-8') as f:
-                                markdown_content = f.read()
-                            logger.info(f"Page {page_number} - Successfully read markdown file: {len(markdown_content)} chars")
-                        else:
-                            logger.warning(f"Page {page_number} - Markdown file not found: {md_file_path}")
-                    except Exception as e:
-                        logger.error(f"Page {page_number} - Failed to read markdown file: {e}")
-                
-                # 检查是否有布局信息文件路径
-                if 'layout_info_path' in first_result:
-                    layout_file_path = first_result['layout_info_path']
-                    logger.info(f"Page {page_number} - Found layout info file path: {layout_file_path}")
-                    
-                    try:
-                        if os.path.exists(layout_file_path):
-                            import json
-                            with open(layout_file_path, 'r', encoding='utf-8') as f:
-                                page_layout = json.load(f)
-                            # 为每个布局元素添加页面信息
-                            for item in page_layout:
-                                if isinstance(item, dict):
-                                    item['page_number'] = page_number
-                            layout_data.extend(page_layout)
-                            logger.info(f"Page {page_number} - Successfully read layout info file: {len(page_layout)} items")
-                        else:
-                            logger.warning(f"Page {page_number} - Layout info file not found: {layout_file_path}")
-                    except Exception as e:
-                        logger.error(f"Page {page_number} - Failed to read layout info file: {e}")
+                # markdown和布局信息文件：一次读取输出目录，读完后删除
+                try:
+                    file_markdown, page_layout = _read_result_files(first_result)
+                    if file_markdown is not None:
+                        markdown_content = file_markdown
+                        logger.info(f"Page {page_number} - Successfully read markdown file: {len(markdown_content)} chars")
+                    if page_layout is not None:
+                        # 为每个布局元素添加页面信息
+                        for item in page_layout:
+                            if isinstance(item, dict):
+                                item['page_number'] = page_number
+                        layout_data.extend(page_layout)
+                        logger.info(f"Page {page_number} - Successfully read layout info file: {len(page_layout)} items")
+                except Exception as e:
+                    logger.error(f"Page {page_number} - Failed to read result files: {e}")
                 
                 # 如果没有文件路径，尝试其他键名（向后兼容）
                 if not markdown_content:
@@ -355,143 +2807,170 @@ def extract_content_from_result(result, page_number):
         logger.error(f"Error extracting content from page {page_number} result: {str(e)}")
         markdown_content = f"Error processing page {page_number}: {str(e)}"
     
+    # 输出压缩：处理markdown中内嵌的base64图片
+    markdown_content = _compact_markdown(markdown_content, image_mode, image_table)
+    
     return markdown_content, layout_data
 
-def process_image_with_dotsocr(parser, image_base64, prompt_type):
+def process_image_with_dotsocr(parser, image_base64, prompt_type, options=None):
     """Process image with DotsOCR and return markdown and layout data"""
     try:
-        # Decode base64 image
-        try:
-            image_data = base64.b64decode(image_base64)
-            image = Image.open(io.BytesIO(image_data))
-            logger.info(f"Image loaded successfully, size: {image.size}")
-        except Exception as e:
-            logger.error(f"Failed to decode image: {e}")
-            return {"error": f"Failed to decode image: {str(e)}"}
+        image_url = (options or {}).get('image_url')
+        if image_url and not image_base64:
+            # 下载到spool文件后完整解码，解码完成即可删除
+            input_document = _download_to_spool(image_url, ".img")
+            try:
+                with _stage("decode"):
+                    image, raster = _open_image(input_document.path, _raster_settings(options))
+                logger.info(f"Image loaded successfully, size: {image.size}")
+            except Exception as e:
+                logger.error(f"Failed to decode image: {e}")
+                return {"error": f"Failed to decode image: {str(e)}"}
+            finally:
+                _remove_spool(input_document.path)
+        else:
+            # Decode base64 image
+            try:
+                with _stage("decode"):
+                    input_document = _InputDocument(base64.b64decode(image_base64), None, None)
+                    image, raster = _open_image(io.BytesIO(input_document.data), _raster_settings(options))
+                logger.info(f"Image loaded successfully, size: {image.size}")
+            except Exception as e:
+                logger.error(f"Failed to decode image: {e}")
+                return {"error": f"Failed to decode image: {str(e)}"}
         
-        # Save image to temporary file for processing
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
-            image.save(tmp_file.name, 'PNG')
-            temp_image_path = tmp_file.name
+        cache_stats = _new_cache_stats(options)
+        document_key = _document_cache_key("image", input_document, prompt_type, options)
+        if cache_stats["enabled"]:
+            cached = _cache_get("documents", document_key)
+            if cached is not None:
+                logger.info("Image result cache hit")
+                cache_stats["document"] = "hit"
+                return {**cached, "cache": _cache_report(cache_stats)}
         
-        try:
-            # Process the image with DotsOCR
-            logger.info("Processing image with DotsOCR...")
-            
-            # 根据README指示，使用正确的解析方法
-            if prompt_type == "layout_parsing":
-                # 解析所有布局信息，包括检测和识别
-                result = parser.parse_file(temp_image_path, prompt_mode="prompt_layout_all_en")
-            elif prompt_type == "layout_detection":
-                # 仅布局检测
-                result = parser.parse_file(temp_image_path, prompt_mode="prompt_layout_only_en")
-            elif prompt_type == "text_only":
-                # 仅文本识别，排除页眉页脚
-                result = parser.parse_file(temp_image_path, prompt_mode="prompt_ocr")
-            else:
-                # 默认使用布局解析
-                result = parser.parse_file(temp_image_path, prompt_mode="prompt_layout_all_en")
-            
-            # 添加详细的调试信息
-            logger.info(f"Raw result type: {type(result)}")
+        region_categories = _region_categories(prompt_type, options)
+        if region_categories is not None:
+            # 两阶段区域识别：与PDF页面共用_parse_regions
+            logger.info(f"Processing image regions {region_categories} with DotsOCR...")
+            image_mode = _image_mode(options)
+            page_result = _parse_regions(parser, [(None, image)], region_categories, _new_batch_state(max(1, _get_int_option(options, "page_batch_size", "DOTSOCR_PAGE_BATCH_SIZE", 1)), options), image_mode)[0]
+            if page_result["status"] == "error":
+                raise RuntimeError(page_result["page_error"])
+            _scale_layout_bboxes(page_result["layout_data"], raster["scale"])
+            response = {
+                "markdown": page_result["markdown"],
+                "layout_data": page_result["layout_data"],
+                "status": "success",
+                "input_type": "image",
+                "raster": raster
+            }
+            if image_mode == "reference":
+                response["images"] = page_result["images"]
+            if cache_stats["enabled"]:
+                _cache_put("documents", document_key, response)
+            response["cache"] = _cache_report(cache_stats)
+            return response
+        
+        # Process the image with DotsOCR
+        logger.info("Processing image with DotsOCR...")
+        with _stage("inference"):
+            result = _infer_images(parser, [image], _prompt_mode_for(prompt_type), ["image"], {"size": 1})[0]
+        if isinstance(result, Exception):
+            raise result
+        
+        # 添加详细的调试信息（完整结果可能很大，仅在DOTSOCR_LOG_PAYLOADS=1时输出）
+        read_start = time.perf_counter()
+        logger.info(f"Raw result type: {type(result)}")
+        if LOG_PAYLOADS:
             logger.info(f"Raw result: {result}")
-            
-            # 尝试不同的结果解析方法
-            markdown_content = ""
-            layout_data = []
-            
-            if isinstance(result, list) and len(result) > 0:
-                logger.info(f"Result is a list with {len(result)} items")
-                first_result = result[0]
-                logger.info(f"First result type: {type(first_result)}")
+        
+        # 尝试不同的结果解析方法
+        markdown_content = ""
+        layout_data = []
+        
+        if isinstance(result, list) and len(result) > 0:
+            logger.info(f"Result is a list with {len(result)} items")
+            first_result = result[0]
+            logger.info(f"First result type: {type(first_result)}")
+            if LOG_PAYLOADS:
                 logger.info(f"First result: {first_result}")
+            
+            # 根据日志发现，parse_file返回的是文件路径，不是直接内容
+            if isinstance(first_result, dict):
+                # markdown和布局信息文件：一次读取输出目录，读完后删除
+                try:
+                    file_markdown, file_layout = _read_result_files(first_result)
+                    if file_markdown is not None:
+                        markdown_content = file_markdown
+                        logger.info(f"Successfully read markdown file: {len(markdown_content)} chars")
+                    if file_layout is not None:
+                        layout_data = file_layout
+                        logger.info(f"Successfully read layout info file: {len(layout_data)} items")
+                except Exception as e:
+                    logger.error(f"Failed to read result files: {e}")
                 
-                # 根据日志发现，parse_file返回的是文件路径，不是直接内容
-                if isinstance(first_result, dict):
-                    # 检查是否有markdown文件路径
-                    if 'md_content_path' in first_result:
-                        md_file_path = first_result['md_content_path']
-                        logger.info(f"Found markdown file path: {md_file_path}")
-                        
-                        # 读取markdown文件内容
-                        try:
-                            if os.path.exists(md_file_path):
-                                with open(md_file_path, 'r', encoding='utf-8') as f:
-                                    markdown_content = f.read()
-                                logger.info(f"Successfully read markdown file: {len(markdown_content)} chars")
-                            else:
-                                logger.warning(f"Markdown file not found: {md_file_path}")
-                        except Exception as e:
-                            logger.error(f"Failed to read markdown file: {e}")
-                    
-                    # 检查是否有布局信息文件路径
-                    if 'layout_info_path' in first_result:
-                        layout_file_path = first_result['layout_info_path']
-                        logger.info(f"Found layout info file path: {layout_file_path}")
-                        
-                        # 读取布局信息JSON文件
-                        try:
-                            if os.path.exists(layout_file_path):
-                                import json
-                                with open(layout_file_path, 'r', encoding='utf-8') as f:
-                                    layout_data = json.load(f)
-                                logger.info(f"Successfully read layout info file: {len(layout_data)} items")
-                            else:
-                                logger.warning(f"Layout info file not found: {layout_file_path}")
-                        except Exception as e:
-                            logger.error(f"Failed to read layout info file: {e}")
-                    
-                    # 如果没有文件路径，尝试其他键名（向后兼容）
-                    if not markdown_content:
-                        for key in ['markdown', 'markdown_content', 'content', 'text', 'result']:
-                            if key in first_result:
-                                markdown_content = first_result[key]
-                                logger.info(f"Found markdown content in key '{key}': {len(str(markdown_content))} chars")
-                                break
-                    
-                    if not layout_data:
-                        for key in ['layout', 'layout_data', 'data', 'elements', 'boxes']:
-                            if key in first_result:
-                                layout_data = first_result[key]
-                                logger.info(f"Found layout data in key '{key}': {len(layout_data)} items")
-                                break
-                else:
-                    # 如果不是字典，直接转换为字符串
-                    markdown_content = str(first_result)
-                    logger.info(f"First result is not dict, converting to string: {len(markdown_content)} chars")
-            elif isinstance(result, dict):
-                logger.info("Result is a dict")
-                # 尝试常见的键名
-                for key in ['markdown', 'markdown_content', 'content', 'text', 'result']:
-                    if key in result:
-                        markdown_content = result[key]
-                        logger.info(f"Found markdown content in key '{key}': {len(str(markdown_content))} chars")
-                        break
+                # 如果没有文件路径，尝试其他键名（向后兼容）
+                if not markdown_content:
+                    for key in ['markdown', 'markdown_content', 'content', 'text', 'result']:
+                        if key in first_result:
+                            markdown_content = first_result[key]
+                            logger.info(f"Found markdown content in key '{key}': {len(str(markdown_content))} chars")
+                            break
                 
-                for key in ['layout', 'layout_data', 'data', 'elements', 'boxes']:
-                    if key in result:
-                        layout_data = result[key]
-                        logger.info(f"Found layout data in key '{key}': {len(layout_data)} items")
-                        break
+                if not layout_data:
+                    for key in ['layout', 'layout_data', 'data', 'elements', 'boxes']:
+                        if key in first_result:
+                            layout_data = first_result[key]
+                            logger.info(f"Found layout data in key '{key}': {len(layout_data)} items")
+                            break
             else:
-                # 其他类型，直接转换为字符串
-                markdown_content = str(result)
-                logger.info(f"Result is other type, converting to string: {len(markdown_content)} chars")
-            
-            logger.info(f"Final markdown length: {len(markdown_content)}")
-            logger.info(f"Final layout data items: {len(layout_data)}")
-            
-            return {
-                "markdown": markdown_content,
-                "layout_data": layout_data,
-                "status": "success",
-                "input_type": "image"
-            }
+                # 如果不是字典，直接转换为字符串
+                markdown_content = str(first_result)
+                logger.info(f"First result is not dict, converting to string: {len(markdown_content)} chars")
+        elif isinstance(result, dict):
+            logger.info("Result is a dict")
+            # 尝试常见的键名
+            for key in ['markdown', 'markdown_content', 'content', 'text', 'result']:
+                if key in result:
+                    markdown_content = result[key]
+                    logger.info(f"Found markdown content in key '{key}': {len(str(markdown_content))} chars")
+                    break
             
-        finally:
-            # Clean up temporary file
-            if os.path.exists(temp_image_path):
-                os.unlink(temp_image_path)
+            for key in ['layout', 'layout_data', 'data', 'elements', 'boxes']:
+                if key in result:
+                    layout_data = result[key]
+                    logger.info(f"Found layout data in key '{key}': {len(layout_data)} items")
+                    break
+        else:
+            # 其他类型，直接转换为字符串
+            markdown_content = str(result)
+            logger.info(f"Result is other type, converting to string: {len(markdown_content)} chars")
+        
+        # 输出压缩：处理markdown中内嵌的base64图片
+        image_mode = _image_mode(options)
+        image_table = {}
+        markdown_content = _compact_markdown(markdown_content, image_mode, image_table)
+        _add_stage_time("result_read", time.perf_counter() - read_start)
+        
+        # 缩小解码（JPEG draft）时把坐标映射回原图
+        if isinstance(layout_data, list):
+            _scale_layout_bboxes(layout_data, raster["scale"])
+        logger.info(f"Final markdown length: {len(markdown_content)}")
+        logger.info(f"Final layout data items: {len(layout_data)}")
+        
+        response = {
+            "markdown": markdown_content,
+            "layout_data": layout_data,
+            "status": "success",
+            "input_type": "image",
+            "raster": raster
+        }
+        if image_mode == "reference":
+            response["images"] = image_table
+        if cache_stats["enabled"]:
+            _cache_put("documents", document_key, response)
+        response["cache"] = _cache_report(cache_stats)
+        return response
                 
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
@@ -499,4 +2978,21 @@ def process_image_with_dotsocr(parser, image_base64, prompt_type):
 
 # Start the Serverless function when the script is run
 if __name__ == '__main__':
-    runpod.serverless.start({'handler': handler })
\ No newline at end of file
+    # DOTSOCR_STREAM=1 时使用生成器handler：输入带"stream": true的PDF任务逐页返回结果（/stream），
+    # 其他任务只输出一次完整响应。开启return_aggregate_stream后/run和/runsync返回输出列表
+    # 在开始接收任务前加载模型并warmup，避免第一个请求承担全部冷启动
+    if os.getenv("DOTSOCR_EAGER_INIT", "1") == "1":
+        _initialize_worker()
+
+    streaming = os.getenv("DOTSOCR_STREAM", "0") == "1"
+    if MAX_CONCURRENCY > 1:
+        # 并发模式：异步handler + concurrency_modifier，推理由共享调度器合并批处理
+        _start_scheduler()
+        if streaming:
+            runpod.serverless.start({'handler': async_stream_handler, 'return_aggregate_stream': True, 'concurrency_modifier': concurrency_modifier})
+        else:
+            runpod.serverless.start({'handler': async_handler, 'concurrency_modifier': concurrency_modifier})
+    elif streaming:
+        runpod.serverless.start({'handler': stream_handler, 'return_aggregate_stream': True})
+    else:
+        runpod.serverless.start({'handler': handler })
\ No newline at end of file